@@ -1,28 +1,346 @@
 import math
+import abc
 from typing import List
 import argparse
 from argparse import RawTextHelpFormatter
 import shutil
 from PIL import Image
 import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import svgwrite
 import os
+import sys
+import re
 import json
+import hashlib
+import time
+import traceback
+import warnings
+import contextlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+try:
+  import resource
+except ImportError:
+  # not available on windows, the peak memory is not recorded there
+  resource = None
+try:
+  import fcntl
+except ImportError:
+  # not available on windows, concurrent updates of the shared caches may lose entries there
+  fcntl = None
+
+## epoch of the integer timestamps of a track
+EPOCH = datetime(1970, 1, 1)
+
+##
+# convert a timestamp into ns since epoch
+def toEpochNs(timestamp:datetime):
+  return (timestamp-EPOCH)//timedelta(microseconds=1)*1000
+
+##
+# sha256 of the content of a file, None if the file doesn't exist
+def fileHash(path):
+  if not os.path.isfile(path):
+    return None
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1<<20), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+##
+# replace path by a file written by write(f), through a temporary file of its own
+# processes sharing the file never write into the same temporary file and readers never see a partial file
+def replaceFile(path, write, mode="w"):
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path)+".", suffix=".tmp")
+  try:
+    with os.fdopen(fd, mode) as f:
+      write(f)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+
+##
+# json file as dict, empty if it doesn't exist or is broken
+def loadJson(path):
+  if not os.path.exists(path):
+    return {}
+  try:
+    with open(path, "r") as f:
+      return json.load(f)
+  except ValueError:
+    return {}
+
+##
+# merge entries into a json file shared by several processes, returns the merged dict
+# the entries are added to the current content of the file, so updates of other processes are kept
+def updateJson(path, entries:dict, indent=None):
+  with open(path + ".lock", "a") as lock:
+    if fcntl is not None:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+    merged = loadJson(path) | entries
+    replaceFile(path, lambda f: json.dump(merged, f, indent=indent))
+  return merged
+
+##
+# peak resident memory of the process in bytes since the last resetPeakRss, None if unknown
+def peakRss():
+  try:
+    # linux, the high water mark that resetPeakRss resets
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1])*1024
+  except OSError:
+    pass
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on linux, bytes on macos
+  return peak if os.uname().sysname == "Darwin" else peak*1024
+
+##
+# reset the peak resident memory to the current one, only possible on linux
+# returns False if peakRss keeps reporting the peak of the whole process
+def resetPeakRss():
+  try:
+    with open("/proc/self/clear_refs", "w") as f:
+      f.write("5")
+    return True
+  except OSError:
+    return False
+
+##
+# folder of the caches shared by all tours
+def cacheHome():
+  return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "GpxAnalyzer")
+
+##
+# find the pictures in a folder, returns a list of (folder, file name)
+# the thumbnails of the lazy photo layer are skipped, recreate uses the output folder as image folder
+def findImages(imageFolder):
+  images = []
+  for root, dirs, files in os.walk(imageFolder):
+    if root == imageFolder and MapCreator.THUMBS_DIR in dirs:
+      dirs.remove(MapCreator.THUMBS_DIR)
+    for f in files:
+      if os.path.splitext(f)[1].lower() in PhotoTimestamps.EXTENSIONS:
+        images.append((root, f))
+  return images
+
+##
+# pack colours given as percentages into one integer per colour, the same way svgwrite.rgb(..., '%') rounds them
+def packColours(r, g, b):
+  packed = np.zeros(np.broadcast(r, g, b).shape, dtype=np.int64)
+  for channel, factor in [(r, 1000000), (g, 1000), (b, 1)]:
+    channel = np.nan_to_num(np.asarray(channel, dtype=np.float64), nan=0, posinf=100, neginf=0)
+    packed = packed + np.clip(channel, 0, 100).astype(np.int64)*factor
+  return packed
+
+##
+# svg colour of a packed colour
+def colourString(packed):
+  return "rgb(%d%%,%d%%,%d%%)" % (packed//1000000, packed//1000%1000, packed%1000)
+
+##
+# Douglas-Peucker simplification of a line in map coordinates, returns the indices of the points to keep
+# keys has one value per segment, points where the key changes are always kept,
+# so all segments merged into one simplified segment share the same key
+def simplifyLine(x, y, tolerance:float, keys=None):
+  count = len(x)
+  if count < 3 or tolerance <= 0:
+    return np.arange(count)
+  keep = np.zeros(count, dtype=bool)
+  keep[0] = keep[-1] = True
+  if keys is not None:
+    keep[1:-1] |= keys[1:] != keys[:-1]
+  anchors = np.flatnonzero(keep)
+  stack = list(zip(anchors[:-1].tolist(), anchors[1:].tolist()))
+  while stack:
+    first, last = stack.pop()
+    if last-first < 2:
+      continue
+    # distance of the points in between to the segment from first to last
+    px, py = x[first+1:last]-x[first], y[first+1:last]-y[first]
+    dx, dy = x[last]-x[first], y[last]-y[first]
+    length = dx*dx+dy*dy
+    t = np.clip((px*dx+py*dy)/length, 0, 1) if length > 0 else 0
+    dist = np.hypot(px-t*dx, py-t*dy)
+    idx = int(np.argmax(dist))
+    if dist[idx] > tolerance:
+      mid = first+1+idx
+      keep[mid] = True
+      stack.append((first, mid))
+      stack.append((mid, last))
+  return np.flatnonzero(keep)
+
+##
+# decoder for the timestamps of the gpx data, e.g. 2023-07-02T07:14:01.154Z or 2023-07-02T07:14:01Z
+# the UTC timestamps are shifted into local time by a configurable offset
+class TimestampDecoder:
+  def __init__(self, tzOffset:float=2) -> None:
+    ## offset of the local time to UTC in hours
+    self.tzOffset = tzOffset
+    self.offset = timedelta(hours=tzOffset)
+
+  ##
+  # decode a single timestamp
+  def decode(self, time:str):
+    # fromisoformat handles both variants with and without fraction, no need to guess the format
+    # a trailing Z is only accepted from python 3.11 on
+    if time.endswith("Z"):
+      time = time[:-1] + "+00:00"
+    timestamp = datetime.fromisoformat(time)
+    if timestamp.tzinfo is not None:
+      timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp+self.offset
+
+  ##
+  # decode a list of timestamps into local ns since epoch
+  def decodeNs(self, times:List[str]):
+    offset = self.offset//timedelta(microseconds=1)*1000
+    try:
+      with warnings.catch_warnings():
+        # numpy only warns about explicit zones, those need the slow path
+        warnings.simplefilter("error")
+        stamps = np.array([time[:-1] if time.endswith("Z") else time for time in times], dtype="datetime64[ns]")
+      return stamps.astype(np.int64)+offset
+    except (ValueError, Warning):
+      return np.array([toEpochNs(self.decode(time)) for time in times], dtype=np.int64)
+
+##
+# timestamps of pictures, taken from the file name or from the exif data of the picture
+# file names are matched against a table of patterns, the numbers are taken directly from the match
+# exif lookups are memoized on disk per path and mtime, so a picture is never opened twice
+class PhotoTimestamps:
+  ## extensions of pictures
+  EXTENSIONS = (".jpg", ".jpeg", ".heic")
+  ## file name patterns, (pattern, whether the time is UTC)
+  # the groups are year, month, day, hour, minute, second and the fraction of the second
+  PATTERNS = [
+    # 20230702_071401.jpg
+    (re.compile(r"^(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})()\.(?:jpe?g|heic)$", re.IGNORECASE), False),
+    # IMG_20230702_071401_154.jpg, MVIMG_20230702_071401_154.jpg
+    (re.compile(r"^(?:IMG|MVIMG)_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})_(\d{1,6})\.(?:jpe?g|heic)$", re.IGNORECASE), False),
+    # PXL_20230702_071401154.jpg, PXL_20230702_071401154.MP.jpg, PXL_20230702_071401154.NIGHT.jpg, ...
+    (re.compile(r"^PXL_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})(\d{1,6})(?:\.[\w-]+)*\.(?:jpe?g|heic)$", re.IGNORECASE), True),
+  ]
+  ## exif tags
+  EXIF_IFD = 0x8769
+  DATETIME_ORIGINAL = 36867
+  OFFSET_TIME_ORIGINAL = 36881
+  DATETIME = 306
+
+  def __init__(self, tzOffset:float=2, cachePath=None) -> None:
+    ## offset of the local time to UTC in hours, for pictures named by UTC time
+    self.offset = timedelta(hours=tzOffset)
+    self.cachePath = cachePath if cachePath is not None else self.defaultCachePath()
+    self.cache = None
+    self.changed = False
+
+  @staticmethod
+  def defaultCachePath():
+    return os.path.join(cacheHome(), "photo_timestamps.json")
+
+  ##
+  # local time the picture was taken, None if it can't be found
+  def get(self, path):
+    timestamp = self.fromName(os.path.basename(path))
+    if timestamp is None:
+      timestamp = self.fromExifCached(path)
+    return timestamp
+
+  def fromName(self, name):
+    for pattern, utc in self.PATTERNS:
+      match = pattern.match(name)
+      if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        timestamp = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), int(fraction.ljust(6, "0")))
+        return timestamp+self.offset if utc else timestamp
+    return None
+
+  def fromExifCached(self, path):
+    if self.cache is None:
+      self.loadCache()
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    key = os.path.abspath(path)
+    entry = self.cache.get(key)
+    if entry is not None and entry[0] == stat.st_mtime_ns:
+      return datetime.fromisoformat(entry[1]) if entry[1] is not None else None
+    timestamp = self.fromExif(path)
+    self.cache[key] = [stat.st_mtime_ns, timestamp.isoformat() if timestamp is not None else None]
+    self.changed = True
+    return timestamp
+
+  ##
+  # time the picture was taken from the exif data, only the header of the picture is read
+  def fromExif(self, path):
+    try:
+      with Image.open(path) as image:
+        exif = image.getexif()
+        details = exif.get_ifd(self.EXIF_IFD)
+        value = details.get(self.DATETIME_ORIGINAL) or exif.get(self.DATETIME)
+        if not value:
+          return None
+        timestamp = datetime.strptime(value.strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+        zone = details.get(self.OFFSET_TIME_ORIGINAL)
+        if zone:
+          # the camera knew its zone, convert to the configured local time via UTC
+          utc = datetime.fromisoformat(timestamp.isoformat()+zone.strip("\x00 ")).astimezone(timezone.utc).replace(tzinfo=None)
+          return utc+self.offset
+        return timestamp
+    except Exception:
+      return None
+
+  def loadCache(self):
+    self.cache = loadJson(self.cachePath)
+
+  ##
+  # write the memoized exif lookups to disk
+  def save(self):
+    if not self.changed:
+      return
+    try:
+      os.makedirs(os.path.dirname(self.cachePath), exist_ok=True)
+      # other processes may have stored pictures since the cache was loaded, keep them
+      self.cache = updateJson(self.cachePath, self.cache)
+      self.changed = False
+    except OSError as ex:
+      # the cache is only an optimization
+      print("could not store the picture timestamps:", ex)
 
 class Config:
-  def __init__(self, margin:float, shrink:bool) -> None:
+  def __init__(self, margin:float, shrink:bool, tzOffset:float=2, photoTolerance:float=60, simplifyTolerance:float=0.5, trackStyle:str="path", smoothWindow:int=5, photoLayer:str="inline") -> None:
     ## margin to side of map
     self.Margin = margin
     ## whether to shrink images
     self.Shrink = shrink
+    ## offset of the local time to the UTC time of the gpx data in hours
+    self.TzOffset = tzOffset
+    ## max time in s a picture may be taken before or after the closest segment
+    self.PhotoTolerance = photoTolerance
+    ## max deviation of the simplified track from the recorded one on the map, 0 to draw every segment
+    self.SimplifyTolerance = simplifyTolerance
+    ## how the track is drawn, "path" merges segments of the same colour, "lines" draws every segment on its own
+    self.TrackStyle = trackStyle
+    ## number of points the elevation and speed are averaged over to smooth gps jitter, 1 to not smooth
+    self.SmoothWindow = smoothWindow
+    ## how the pictures are shown on the picture map, "inline" puts every marker into the svg,
+    # "lazy" loads them from photos.json and only shows the markers in view
+    self.PhotoLayer = photoLayer
     ## original creation Date
     self.creationDate = datetime.today().strftime('%Y-%m-%d')
 
 ##
 # track point class representing a track point of the gpx data
 class trkpnt:
-  def __init__(self, lat, lon, ele, time):
+  def __init__(self, lat, lon, ele, time, decoder:TimestampDecoder=None):
     self.lat = float(lat)
     self.lon = float(lon)
     self.ele = float(ele)
@@ -30,11 +348,9 @@ class trkpnt:
     self.isScaled = False
     self.scaledlat=self.lat
     self.scaledlon=self.lon
-    # 2023-07-02T07:14:01.154Z
-    try:
-      self.timestamp = datetime.strptime(self.time,'%Y-%m-%dT%H:%M:%SZ')+timedelta(hours=2, minutes=0)
-    except:
-      self.timestamp = datetime.strptime(self.time,'%Y-%m-%dT%H:%M:%S.%fZ')+timedelta(hours=2, minutes=0)
+    if decoder is None:
+      decoder = TimestampDecoder()
+    self.timestamp = decoder.decode(self.time)
     self.date = self.time.split("T")[0]
     
   def scale(self, topleft, botright, size):
@@ -49,29 +365,1036 @@ class trkpnt:
 ##
 # waypoint class represening a waypoint of the gpx data  
 class wypnt(trkpnt):
-  def __init__(self, lat, lon, ele, time, desc):
-    super().__init__(lat, lon, ele, time)
+  def __init__(self, lat, lon, ele, time, desc, decoder:TimestampDecoder=None):
+    super().__init__(lat, lon, ele, time, decoder)
     self.desc=desc
     
   def __repr__(self):
     return self.desc + "-" + super().__repr__()
 
+## mean earth radius in cm
+EARTH_RADIUS = 637100880
+
+##
+# great circle distances between consecutive points in cm, haversine formula over whole arrays
+def segmentDistances(lat, lon):
+  lat = np.radians(lat)
+  lon = np.radians(lon)
+  a = np.sin(np.diff(lat)*0.5)**2+np.cos(lat[:-1])*np.cos(lat[1:])*np.sin(np.diff(lon)*0.5)**2
+  return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
 ##
-# track segment defined by origin track point and target track point    
-class Segment:
-  def __init__(self, origin:trkpnt, target:trkpnt):
-    self.orig=origin
-    self.target=target
+# centered rolling mean over window values, values that aren't finite are ignored
+# the window shrinks at the ends, so the result has the same length as values
+def rollingMean(values, window:int):
+  values = np.asarray(values, dtype=np.float64)
+  if window <= 1 or len(values) == 0:
+    return values
+  finite = np.isfinite(values)
+  sums = np.concatenate(([0.0], np.cumsum(np.where(finite, values, 0.0))))
+  counts = np.concatenate(([0], np.cumsum(finite)))
+  start = np.clip(np.arange(len(values))-window//2, 0, len(values))
+  end = np.clip(start+window, 0, len(values))
+  with np.errstate(divide="ignore", invalid="ignore"):
+    return (sums[end]-sums[start])/(counts[end]-counts[start])
+
+##
+# range between the low and high percentile of the finite values, so single bad fixes don't compress the colour scale
+# the range is at least 1 wide, so it can always be divided by
+def percentileRange(values, low:float=2, high:float=98):
+  values = np.asarray(values, dtype=np.float64)
+  values = values[np.isfinite(values)]
+  if len(values) == 0:
+    return 0.0, 1.0
+  minvalue, maxvalue = (float(v) for v in np.percentile(values, [low, high]))
+  return minvalue, max(maxvalue, minvalue+1)
+
+##
+# total climb and descent of values, changes smaller than threshold are gps noise and ignored
+# a change counts once the values moved threshold away from the last counted value
+# whether a value counts depends on the value counted before, so this is a loop and not one numpy pass,
+# counting every step of the smoothed np.diff above threshold instead drops the slow climbs
+def climbs(values, threshold:float):
+  gain = 0.0
+  loss = 0.0
+  values = np.asarray(values, dtype=np.float64)
+  values = values[np.isfinite(values)].tolist()
+  if not values:
+    return gain, loss
+  reference = values[0]
+  for value in values:
+    if value-reference >= threshold:
+      gain += value-reference
+      reference = value
+    elif reference-value >= threshold:
+      loss += reference-value
+      reference = value
+  return gain, loss
+
+##
+# columnar track of the gpx data
+# every attribute of the track points is one numpy array, segment i goes from point i to point i+1
+class Track:
+  ## a pause of more than this many s starts a new leg
+  LEG_BREAK = 3000
+  ## elevation change in m below which the smoothed elevation is considered noise
+  CLIMB_THRESHOLD = 3
+
+  def __init__(self, lat, lon, ele, time, x=None, y=None) -> None:
+    self.lat = np.asarray(lat, dtype=np.float64)
+    self.lon = np.asarray(lon, dtype=np.float64)
+    self.ele = np.asarray(ele, dtype=np.float64)
+    ## local time in ns since epoch
+    self.time = np.asarray(time, dtype=np.int64)
+    ## coordinates on the map, x from longitude, y from latitude
+    self.isScaled = x is not None and y is not None
+    self.x = np.asarray(x, dtype=np.float64) if self.isScaled else self.lon.copy()
+    self.y = np.asarray(y, dtype=np.float64) if self.isScaled else self.lat.copy()
+    self.mergeDuplicates()
+    self.computeSegments()
+
+  def __len__(self):
+    return len(self.time)
+
+  def scale(self, topleft, botright, size):
+    self.x = (self.lon-topleft[1])*(size[1]/(-topleft[1]+botright[1]))
+    self.y = (topleft[0]-self.lat)*size[0]/(topleft[0]-botright[0])
+    self.isScaled = True
+    return True
+
+  ##
+  # merge consecutive points with the same timestamp into one at their mean position, so no segment has zero duration
+  def mergeDuplicates(self):
+    if len(self) < 2:
+      return
+    first = np.concatenate(([True], np.diff(self.time) != 0))
+    if first.all():
+      return
+    group = np.cumsum(first)-1
+    counts = np.bincount(group)
+    mean = lambda values: np.bincount(group, weights=values)/counts
+    self.lat, self.lon, self.ele, self.x, self.y = (mean(v) for v in (self.lat, self.lon, self.ele, self.x, self.y))
+    self.time = self.time[first]
+
+  ##
+  # compute the values of all segments at once
+  def computeSegments(self):
     # dist in cm
-    self.distance=math.sqrt((origin.lon-target.lon)**2+(origin.lat-target.lat)**2)/2*11113900
-    self.time = (target.timestamp-origin.timestamp).total_seconds()
-    # speed cm/s
-    self.speed = self.distance/self.time
-    self.avele = (origin.ele+target.ele)*0.5
+    self.distance = segmentDistances(self.lat, self.lon)
+    # distance from the start to each point in cm
+    self.cumDistance = np.concatenate(([0.0], np.cumsum(self.distance)))
+    # time in s
+    self.duration = np.diff(self.time)/1e9
+    # speed cm/s, nan if the time doesn't move forward
+    with np.errstate(divide="ignore", invalid="ignore"):
+      self.speed = np.where(self.duration > 0, self.distance/self.duration, np.nan)
+    self.avele = (self.ele[:-1]+self.ele[1:])*0.5
+
+  def segmentCount(self):
+    return max(len(self)-1, 0)
+
+  ##
+  # summary of the tour, distances in km, times in s, elevations in m and speeds in km/h
+  # the average speed is over the moving time without the breaks between legs,
+  # the max speed and the elevations come from values smoothed over smoothWindow points, so single bad fixes don't count
+  def stats(self, smoothWindow:int=5):
+    duration = float(self.time[-1]-self.time[0])/1e9 if len(self) else 0.0
+    distance = float(self.cumDistance[-1])/1e5
+    moving = (self.duration > 0) & (self.duration <= self.LEG_BREAK)
+    movingTime = float(self.duration[moving].sum())
+    movingDistance = float(self.distance[moving].sum())/1e5
+    # distance over time of the window, a segment with a tiny duration can't dominate it like a mean of speeds
+    with np.errstate(divide="ignore", invalid="ignore"):
+      speed = rollingMean(np.where(moving, self.distance, np.nan), smoothWindow)/rollingMean(np.where(moving, self.duration, np.nan), smoothWindow)
+    speed = speed[np.isfinite(speed)]
+    elevation = rollingMean(self.ele, smoothWindow)
+    gain, loss = climbs(elevation, self.CLIMB_THRESHOLD)
+    return {
+      "points": len(self),
+      "distance": round(distance, 3),
+      "duration": round(duration, 1),
+      "movingTime": round(movingTime, 1),
+      "elevationGain": round(gain, 1),
+      "elevationLoss": round(loss, 1),
+      "minElevation": round(float(elevation.min()), 1) if len(self) else None,
+      "maxElevation": round(float(elevation.max()), 1) if len(self) else None,
+      "averageSpeed": round(movingDistance/movingTime*3600, 2) if movingTime > 0 else None,
+      "maxSpeed": round(float(speed.max())*0.036, 2) if len(speed) else None,
+    }
+
+  ##
+  # center of segment idx on the map
+  def segmentCenter(self, idx):
+    return (float(self.x[idx]+self.x[idx+1])/2, float(self.y[idx]+self.y[idx+1])/2)
+
+  ##
+  # date of point idx
+  def date(self, idx):
+    return str(np.datetime64(int(self.time[idx]), "ns").astype("datetime64[D]"))
+
   def __repr__(self):
-    return "speed: "+str(self.speed)
+    return "track with {n} points".format(n=len(self))
+
+##
+# index over the start times of the segments of a track
+# finds the segments of timestamps by binary search instead of comparing against every segment
+class SegmentTimeIndex:
+  def __init__(self, track:Track) -> None:
+    starts = track.time[:-1]
+    # gpx data is sorted by time already, only sort if it isn't
+    if len(starts) > 1 and np.any(np.diff(starts) < 0):
+      self.order = np.argsort(starts, kind="stable")
+    else:
+      self.order = np.arange(len(starts))
+    self.starts = starts[self.order]
+    self.ends = track.time[1:][self.order]
+
+  ##
+  # get the segment indices for all timestamps (ns) at once, -1 if there is no segment
+  # a timestamp matches the segment it lies in, with a tolerance (s) also the closest segment within the tolerance
+  def lookup(self, timestamps, tolerance:float=0):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    result = np.full(len(timestamps), -1, dtype=np.int64)
+    count = len(self.starts)
+    if count == 0 or len(timestamps) == 0:
+      return result
+    # last segment starting before the timestamp
+    before = np.searchsorted(self.starts, timestamps, side="left")-1
+    candidate = np.clip(before, 0, count-1)
+    inside = (before >= 0) & (self.ends[candidate] > timestamps)
+    result[inside] = candidate[inside]
+    if tolerance > 0:
+      # distance to the end of the segment before and to the start of the segment after the timestamp
+      after = np.clip(before+1, 0, count-1)
+      distBefore = np.where(before >= 0, timestamps-self.ends[candidate], np.iinfo(np.int64).max)
+      distAfter = np.where(before+1 < count, self.starts[after]-timestamps, np.iinfo(np.int64).max)
+      nearest = np.where(distBefore <= distAfter, candidate, after)
+      dist = np.minimum(distBefore, distAfter)
+      near = ~inside & (dist <= int(tolerance*1e9))
+      result[near] = nearest[near]
+    matched = result >= 0
+    result[matched] = self.order[result[matched]]
+    return result
+
+##
+# layout of the picture markers on the map, moves overlapping markers apart
+# the markers are kept in a uniform grid with the overlap distance as cell size,
+# so a marker is only tested against the markers of the neighbouring cells
+class MarkerLayout:
+  def __init__(self, size, overlapdist:float=8, movefac:float=10, maxIterations:int=100) -> None:
+    # map size, [height, width]
+    self.size = size
+    # distance between markers to consider them overlapping
+    self.overlapdist = overlapdist
+    # distance to move overlapping markers away from each other
+    self.movefac = movefac
+    self.maxIterations = maxIterations
+    ## number of passes of the last resolve
+    self.iterations = 0
+    ## number of overlapping marker pairs left after the last resolve
+    self.residualOverlaps = 0
+
+  def cell(self, center):
+    return (int(center[0]//self.overlapdist), int(center[1]//self.overlapdist))
+
+  ##
+  # limit a position to the map
+  def clamp(self, x, y):
+    x = min(max(x,self.overlapdist),self.size[1]-self.overlapdist)
+    y = min(max(y,self.overlapdist),self.size[0]-self.overlapdist)
+    return (x, y)
+
+  ##
+  # markers in the grid cells around center
+  def neighbours(self, grid, center):
+    cx, cy = self.cell(center)
+    found = []
+    for dx in (-1, 0, 1):
+      for dy in (-1, 0, 1):
+        found.extend(grid.get((cx+dx, cy+dy), ()))
+    return found
+
+  def overlaps(self, a, b):
+    return math.dist(a, b) <= self.overlapdist
+
+  ##
+  # move overlapping centers apart until there are no overlaps or the max number of passes is reached
+  def resolve(self, centers):
+    centers = list(centers)
+    self.iterations = 0
+    collissionFree = False
+    while not collissionFree and self.iterations < self.maxIterations:
+      collissionFree = self.resolvePass(centers)
+      self.iterations = self.iterations + 1
+    self.residualOverlaps = self.countOverlaps(centers)
+    return centers
+
+  ##
+  # one pass over all markers, each marker is checked against the markers placed before it
+  def resolvePass(self, centers):
+    collissionFree = True
+    grid = {}
+    for idx, center in enumerate(centers):
+      for other in self.neighbours(grid, center):
+        c = centers[other]
+        d = math.dist(c, center)
+        if d > self.overlapdist:
+          continue
+        if d > 0:
+          dx, dy = (c[0]-center[0])/d, (c[1]-center[1])/d
+        else:
+          # markers on the same spot, spread them by a fixed angle per marker
+          angle = idx*2.399963
+          dx, dy = math.cos(angle), math.sin(angle)
+        # move both markers away from each other
+        center = self.clamp(center[0]-dx*self.movefac, center[1]-dy*self.movefac)
+        moved = self.clamp(c[0]+dx*self.movefac, c[1]+dy*self.movefac)
+        grid[self.cell(c)].remove(other)
+        grid.setdefault(self.cell(moved), []).append(other)
+        centers[other] = moved
+        # we had a collission
+        collissionFree = False
+      centers[idx] = center
+      grid.setdefault(self.cell(center), []).append(idx)
+    return collissionFree
+
+  ##
+  # number of overlapping pairs of centers
+  def countOverlaps(self, centers):
+    count = 0
+    grid = {}
+    for idx, center in enumerate(centers):
+      count = count + sum(1 for other in self.neighbours(grid, center) if self.overlaps(centers[other], center))
+      grid.setdefault(self.cell(center), []).append(idx)
+    return count
+
+##
+# create a thumbnail of a picture, runs in the worker processes of the ImageStage
+def createThumbnail(src, dst, size):
+  with Image.open(src) as image:
+    # let the jpeg decoder scale down while decoding instead of decoding the full picture
+    image.draft("RGB", size)
+    image.thumbnail(size)
+    # keep the exif, recreate takes the time a picture was taken from the thumbnail
+    image.save(dst, exif=image.info.get("exif", b""))
+  return dst
+
+##
+# stage copying or shrinking the pictures of a tour into the output folder
+# thumbnails are created in a process pool, pictures whose content didn't change since the last run are skipped
+class ImageStage:
+  ## name of the cache file in the output folder
+  CACHEFILE = ".imagecache.json"
+
+  def __init__(self, out, shrink:bool, size=(400,300), workers:int=None) -> None:
+    self.out = out
+    self.shrink = shrink
+    self.size = size
+    self.workers = workers
+    self.cachePath = os.path.join(out, self.CACHEFILE)
+    # a broken cache only means all pictures are processed again
+    self.cache = loadJson(self.cachePath)
+    ## number of pictures processed and skipped in the last run
+    self.processed = 0
+    self.skipped = 0
+
+  ##
+  # hash of the content of a picture, reused from the cache while size and mtime are unchanged
+  def contentHash(self, src, entry):
+    stat = os.stat(src)
+    if entry and entry.get("mtime") == stat.st_mtime_ns and entry.get("size") == stat.st_size:
+      return entry["hash"], stat
+    return fileHash(src), stat
+
+  ##
+  # key of the output, changes when the picture or the way it is processed changes
+  def outputKey(self, contentHash):
+    if self.shrink:
+      return "{h}-{w}x{hh}".format(h=contentHash, w=self.size[0], hh=self.size[1])
+    return contentHash + "-copy"
+
+  ##
+  # process the pictures, given as list of (source path, file name)
+  def process(self, images):
+    todo = []
+    self.skipped = 0
+    for src, name in images:
+      dst = os.path.join(self.out, name)
+      entry = self.cache.get(name)
+      contentHash, stat = self.contentHash(src, entry)
+      key = self.outputKey(contentHash)
+      self.cache[name] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": contentHash, "key": entry["key"] if entry else None}
+      if entry and entry.get("key") == key and os.path.exists(dst):
+        self.skipped = self.skipped + 1
+        continue
+      todo.append((src, dst, name, key))
+    if self.shrink and len(todo) > 1:
+      with ProcessPoolExecutor(self.workers) as pool:
+        futures = {pool.submit(createThumbnail, src, dst, self.size): (name, key) for src, dst, name, key in todo}
+        for future in as_completed(futures):
+          self.finish(future.result, *futures[future])
+    else:
+      for src, dst, name, key in todo:
+        if self.shrink:
+          self.finish(lambda: createThumbnail(src, dst, self.size), name, key)
+        else:
+          self.finish(lambda: shutil.copyfile(src, dst), name, key)
+    self.processed = len(todo)
+    replaceFile(self.cachePath, lambda f: json.dump(self.cache, f))
+    print("pictures processed: {processed}, unchanged: {skipped}".format(processed=self.processed, skipped=self.skipped))
+
+  ##
+  # store the key of a finished picture, failed pictures are processed again in the next run
+  def finish(self, result, name, key):
+    try:
+      result()
+      self.cache[name]["key"] = key
+    except Exception as ex:
+      print("could not process picture", name, ex)
+
+##
+# manifest of the build of a tour, stored in the output folder
+# keeps the hashes of the inputs and of the output of every generated file,
+# a file only has to be generated again if one of its inputs changed or the output was modified
+class BuildManifest:
+  ## name of the manifest file in the output folder
+  FILENAME = ".build_manifest.json"
+
+  def __init__(self, out) -> None:
+    self.out = out
+    self.path = os.path.join(out, self.FILENAME)
+    # a broken manifest only means everything is generated again
+    self.entries = loadJson(self.path)
+
+  def isUpToDate(self, name, inputs:dict):
+    entry = self.entries.get(name)
+    if entry is None or entry["inputs"] != inputs:
+      return False
+    return fileHash(os.path.join(self.out, name)) == entry["output"]
+
+  def update(self, name, inputs:dict):
+    self.entries[name] = {"inputs": inputs, "output": fileHash(os.path.join(self.out, name))}
+
+  def save(self):
+    replaceFile(self.path, lambda f: json.dump(self.entries, f, indent=1))
+
+##
+# wall time, cpu time, counts and peak memory of the stages of building a tour
+# stages can be nested, every stage is recorded when it ends, so inner stages come first
+# nothing is recorded unless enabled, so the stages can stay in the code
+class BuildStats:
+  ## name of the stats file in the output folder
+  FILENAME = "build_stats.json"
+
+  def __init__(self, enabled:bool=False) -> None:
+    self.enabled = enabled
+    ## recorded stages in the order they started, dicts of name, depth, start, wall and cpu time in s, counts and peak rss in bytes
+    self.stages = []
+    ## recorded stages that are still running, the innermost last
+    self.running = []
+    # start times are relative to the creation
+    self.origin = time.perf_counter()
+
+  @property
+  def depth(self):
+    return len(self.running)
+
+  ##
+  # record the stage, counts can be given up front or added to the yielded dict
+  # the peak rss is the one of the stage and the stages it contains where the peak can be reset,
+  # the peak of the whole process before otherwise
+  @contextlib.contextmanager
+  def stage(self, name, **counts):
+    if not self.enabled:
+      yield counts
+      return
+    record = {"stage": name, "depth": self.depth, "start": round(time.perf_counter()-self.origin, 6), "wall": None, "cpu": None, "counts": counts, "peakRss": None}
+    self.stages.append(record)
+    # the peak so far belongs to the running stages, the new stage starts from the current rss
+    self.updatePeaks(peakRss())
+    resetPeakRss()
+    self.running.append(record)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+      yield counts
+    finally:
+      record["wall"] = round(time.perf_counter()-wall, 6)
+      record["cpu"] = round(time.process_time()-cpu, 6)
+      self.updatePeaks(peakRss())
+      self.running.pop()
+
+  ##
+  # raise the peak rss of the running stages to peak
+  def updatePeaks(self, peak):
+    if peak is None:
+      return
+    for record in self.running:
+      record["peakRss"] = max(record["peakRss"] or 0, peak)
+
+  ##
+  # add the stages recorded in a worker process, as children of the running stage
+  def extend(self, other:"BuildStats"):
+    shift = other.origin-self.origin
+    for stage in other.stages:
+      self.stages.append(stage | {"depth": stage["depth"]+self.depth, "start": round(stage["start"]+shift, 6)})
+
+  ##
+  # wall and cpu time per stage name, summed over all recordings
+  def totals(self):
+    totals = {}
+    for stage in self.stages:
+      total = totals.setdefault(stage["stage"], {"wall": 0.0, "cpu": 0.0, "count": 0, "peakRss": None})
+      total["wall"] += stage["wall"]
+      total["cpu"] += stage["cpu"]
+      total["count"] += 1
+      if stage["peakRss"] is not None:
+        total["peakRss"] = max(total["peakRss"] or 0, stage["peakRss"])
+    return totals
+
+  def save(self, out):
+    if not self.enabled:
+      return
+    with open(os.path.join(out, self.FILENAME), "w") as f:
+      json.dump({"stages": self.stages, "totals": self.totals()}, f, indent=1)
+    for stage in sorted(self.stages, key=lambda stage: (stage["start"], stage["depth"])):
+      print("{indent}{name:<{width}} {wall:9.3f} s wall {cpu:9.3f} s cpu".format(indent="  "*stage["depth"], name=stage["stage"], width=24-2*stage["depth"], wall=stage["wall"], cpu=stage["cpu"]))
+
+##
+# cache of the parsed and scaled track of a tour, stored next to the cfg.json of the tour
+# the columns of the track are stored in one .npy file that is memory mapped when loading,
+# the name and map bounds in a json file
+# the cache is only used if the gpx file, the margin, the map size and the time zone offset are the same
+class TrackCache:
+  ## name of the cache folder
+  DIRNAME = ".trackcache"
+  ## columns of the cached track
+  DTYPE = np.dtype([("lat", np.float64), ("lon", np.float64), ("ele", np.float64), ("x", np.float64), ("y", np.float64), ("time", np.int64)])
+
+  def __init__(self, directory) -> None:
+    self.directory = os.path.join(directory, self.DIRNAME)
+    self.metaPath = os.path.join(self.directory, "track.json")
+    self.dataPath = os.path.join(self.directory, "track.npy")
+
+  ##
+  # key of a cached track, changes with every input the scaled track depends on
+  @staticmethod
+  def key(gpxHash, margin, size, tzOffset):
+    return hashlib.sha256(json.dumps([gpxHash, margin, list(size), tzOffset]).encode()).hexdigest()
+
+  ##
+  # the stored meta data, None if there is none
+  def loadMeta(self):
+    return loadJson(self.metaPath) or None
+
+  ##
+  # load the meta data and the track if they were stored with the same key, otherwise None
+  def load(self, key):
+    meta = self.loadMeta()
+    if meta is None or meta.get("key") != key or not os.path.exists(self.dataPath):
+      return None
+    # no copy, the columns are views into the mapped file
+    data = np.load(self.dataPath, mmap_mode="r")
+    return meta, Track(data["lat"], data["lon"], data["ele"], data["time"], data["x"], data["y"])
+
+  def save(self, key, meta:dict, track:Track):
+    os.makedirs(self.directory, exist_ok=True)
+    data = np.empty(len(track), dtype=self.DTYPE)
+    for column in self.DTYPE.names:
+      data[column] = getattr(track, column)
+    # the old key goes first and the new one last, a crash must not leave a cache with a valid key but other data
+    if os.path.exists(self.metaPath):
+      os.remove(self.metaPath)
+    replaceFile(self.dataPath, lambda f: np.save(f, data), "wb")
+    replaceFile(self.metaPath, lambda f: json.dump(meta | {"key": key}, f))
+
+##
+# area of a map, the bounding box and the scale of the openstreetmap export
+class MapRequest:
+  def __init__(self, bbox, scale, url=None) -> None:
+    ## min longitude, min latitude, max longitude, max latitude
+    self.bbox = [float(value) for value in bbox]
+    self.scale = int(round(scale))
+    ## link to export the map from openstreetmap
+    self.url = url
+
+  ##
+  # key of the map, readable so maps can be placed in a map folder by hand
+  def key(self):
+    return "{0:.6f}_{1:.6f}_{2:.6f}_{3:.6f}_{4}".format(*self.bbox, self.scale)
+
+  ##
+  # whether this map covers the other with the same scale
+  def contains(self, other:"MapRequest"):
+    return (self.scale == other.scale and self.bbox[0] <= other.bbox[0] and self.bbox[1] <= other.bbox[1]
+      and self.bbox[2] >= other.bbox[2] and self.bbox[3] >= other.bbox[3])
+
+  def area(self):
+    return (self.bbox[2]-self.bbox[0])*(self.bbox[3]-self.bbox[1])
+
+  def toJson(self):
+    return {"bbox": self.bbox, "scale": self.scale}
+
+  ##
+  # the map stored next to a map.svg, None if there is none
+  @staticmethod
+  def load(path):
+    data = loadJson(path)
+    if "bbox" not in data or "scale" not in data:
+      return None
+    return MapRequest(data["bbox"], data["scale"])
+
+##
+# source of the base maps of the tours
+class MapProvider(abc.ABC):
+  ## name of the provider on the command line
+  NAME = None
+
+  ##
+  # write the map of the request as svg to target
+  @abc.abstractmethod
+  def fetch(self, request:MapRequest, target):
+    pass
+
+##
+# the map is exported from openstreetmap by hand and placed in the working dir
+# manual intervention neccessary, OSM doesn't like getting it via code
+class ManualMapProvider(MapProvider):
+  NAME = "manual"
+
+  def __init__(self, mapFile="map.svg") -> None:
+    self.mapFile = mapFile
+
+  def fetch(self, request:MapRequest, target):
+    print("download file and place the resulting file as " + self.mapFile + " in the working dir:")
+    print(request.url)
+    print("you might need to download any map manually first for openstreetmap to accept the link")
+    input("press enter once done")
+    shutil.copyfile(self.mapFile, target)
+
+##
+# maps from a folder of svg files named by the key of their request, runs unattended and without network
+class FilesystemMapProvider(MapProvider):
+  NAME = "filesystem"
+
+  def __init__(self, directory) -> None:
+    self.directory = directory
+
+  def fetch(self, request:MapRequest, target):
+    path = os.path.join(self.directory, request.key() + ".svg")
+    if not os.path.exists(path):
+      raise FileNotFoundError("no map " + path + ", export it from " + str(request.url))
+    shutil.copyfile(path, target)
+
+##
+# content addressed cache of the maps of all tours
+# the maps are stored by the hash of their content, an index maps the keys of the requests to them
+# a request is served by the map of the same key or by the smallest map of the same scale covering it
+class MapCache:
+  INDEX = "index.json"
+
+  def __init__(self, directory) -> None:
+    self.directory = directory
+    self.indexPath = os.path.join(directory, self.INDEX)
+    self.index = loadJson(self.indexPath)
+
+  @staticmethod
+  def defaultPath():
+    return os.path.join(cacheHome(), "maps")
+
+  def objectPath(self, contentHash):
+    return os.path.join(self.directory, contentHash + ".svg")
+
+  ##
+  # path and request of the cached map for the request, None if there is none
+  def find(self, request:MapRequest):
+    candidates = []
+    for key, entry in self.index.items():
+      cached = MapRequest(entry["bbox"], entry["scale"])
+      if (key == request.key() or cached.contains(request)) and os.path.exists(self.objectPath(entry["hash"])):
+        candidates.append((key != request.key(), cached.area(), entry["hash"], cached))
+    if not candidates:
+      return None
+    _, _, contentHash, cached = min(candidates, key=lambda candidate: candidate[:2])
+    return self.objectPath(contentHash), cached
+
+  def store(self, request:MapRequest, path):
+    os.makedirs(self.directory, exist_ok=True)
+    contentHash = fileHash(path)
+    if not os.path.exists(self.objectPath(contentHash)):
+      with open(path, "rb") as src:
+        replaceFile(self.objectPath(contentHash), lambda f: shutil.copyfileobj(src, f), "wb")
+    # other processes may have stored maps since the index was loaded, keep them
+    self.index = updateJson(self.indexPath, {request.key(): request.toJson() | {"hash": contentHash}}, indent=1)
+
+##
+# index of the pictures of a folder, sorted by the time they were taken
+# the folder is scanned and the file names are parsed once, every tour then takes the pictures of its time range
+class PhotoIndex:
+  def __init__(self, imageFolder, photoTimestamps:PhotoTimestamps) -> None:
+    images = []
+    times = []
+    for root, f in findImages(imageFolder):
+      timestamp = photoTimestamps.get(os.path.join(root, f))
+      if timestamp is not None:
+        images.append((root, f))
+        times.append(toEpochNs(timestamp))
+    order = np.argsort(np.array(times, dtype=np.int64), kind="stable")
+    ## local time the pictures were taken in ns since epoch, sorted
+    self.times = np.array(times, dtype=np.int64)[order]
+    ## pictures as (folder, file name), in the order of times
+    self.images = [images[i] for i in order.tolist()]
+
+  def __len__(self):
+    return len(self.images)
+
+  ##
+  # pictures taken between start and end (ns), as (folder, file name, time)
+  def between(self, start, end):
+    first = int(np.searchsorted(self.times, start, side="left"))
+    last = int(np.searchsorted(self.times, end, side="right"))
+    return [(root, f, timestamp) for (root, f), timestamp in zip(self.images[first:last], self.times[first:last].tolist())]
+
+##
+# data shared by all maps of a tour
+# computed in one pass before rendering, so the maps can be rendered in parallel without recomputing anything
+class RenderData:
+  def __init__(self, track:Track, size) -> None:
+    self.track = track
+    ## map size, [height, width]
+    self.size = size
+    ## packed colours of the segments per map
+    self.colours = {}
+    ## indices of the points of the simplified track per map, filled in by the map renderer
+    self.kept = {}
+    ## ranges of the colour scales per map, (min, max)
+    self.ranges = {}
+    ## start date of every leg
+    self.legdates = []
+    ## pictures on the track, (segment, file name)
+    self.pictures = []
+
+##
+# page template compiled into literal and placeholder chunks, rendered with a single join
+# templates are loaded from the folder of this script and compiled once per process
+class PageTemplate:
+  ## placeholders look like {{NAME}}
+  PLACEHOLDER = re.compile(r"\{\{(\w+)\}\}")
+  ## folder of the templates
+  DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+  ## compiled templates by path
+  compiled = {}
+
+  def __init__(self, text:str) -> None:
+    parts = self.PLACEHOLDER.split(text)
+    ## literal text, one more than there are placeholders
+    self.literals = parts[0::2]
+    ## names of the placeholders between the literals
+    self.names = parts[1::2]
+
+  @classmethod
+  def path(cls, name):
+    return os.path.join(cls.DIRECTORY, name)
+
+  ##
+  # the compiled template of the file name
+  @classmethod
+  def load(cls, name):
+    path = cls.path(name)
+    if path not in cls.compiled:
+      with open(path, "r", encoding="utf-8") as f:
+        cls.compiled[path] = PageTemplate(f.read())
+    return cls.compiled[path]
+
+  ##
+  # fill in the placeholders, unknown placeholders are kept as they are
+  def render(self, values:dict):
+    chunks = [self.literals[0]]
+    for name, literal in zip(self.names, self.literals[1:]):
+      chunks.append(str(values[name]) if name in values else "{{" + name + "}}")
+      chunks.append(literal)
+    return "".join(chunks)
+
+##
+# streaming reader for gpx data
+# reads the track name, waypoints and the track points of all tracks and track segments in a single pass
+# elements are dropped from the tree once they are handled, so memory stays flat even for huge recordings
+class GpxReader:
+  def __init__(self, decoder:TimestampDecoder=None) -> None:
+    self.decoder = decoder if decoder is not None else TimestampDecoder()
+    ## name of the first track in the file
+    self.name = None
+    self.waypoints = []
+    # columns of the track points
+    self.lat = []
+    self.lon = []
+    self.ele = []
+    self.time = []
+
+  @staticmethod
+  def localName(tag):
+    # strip the namespace, gpx 1.0 and 1.1 files use different ones
+    return tag.rsplit("}", 1)[-1]
+
+  @staticmethod
+  def childText(elem, name, default=None):
+    for child in elem:
+      if GpxReader.localName(child.tag) == name:
+        return child.text
+    return default
+
+  def read(self, gpxData):
+    # stack of currently open elements, the last one is the parent of the element that ends
+    stack = []
+    for event, elem in ET.iterparse(gpxData, events=("start", "end")):
+      if event == "start":
+        stack.append(elem)
+        continue
+      stack.pop()
+      tag = self.localName(elem.tag)
+      if tag == "trkpt":
+        time = self.childText(elem, "time")
+        # points without time can't be used for segments
+        if time is not None:
+          self.lat.append(float(elem.get("lat")))
+          self.lon.append(float(elem.get("lon")))
+          self.ele.append(float(self.childText(elem, "ele", "0")))
+          # decoded in one go once all points are read
+          self.time.append(time)
+      elif tag == "wpt":
+        time = self.childText(elem, "time")
+        if time is not None:
+          self.waypoints.append(wypnt(elem.get("lat"), elem.get("lon"), self.childText(elem, "ele", "0"), time, self.childText(elem, "desc", ""), self.decoder))
+      elif tag == "name":
+        if self.name is None and stack and self.localName(stack[-1].tag) == "trk":
+          self.name = elem.text
+        continue
+      elif tag not in ("trkseg", "trk"):
+        # children of points are handled together with their point
+        continue
+      # done with the element, remove it from its parent so it can be freed
+      elem.clear()
+      if stack:
+        stack[-1].remove(elem)
+    return self.name, self.waypoints, Track(self.lat, self.lon, self.ele, self.decoder.decodeNs(self.time))
   
 class MapCreator:
+  ## maps of a tour and the methods rendering them
+  MAPS = {"picture": "createImageMap", "elevation": "createEleMap", "speed": "createSpeedMap", "legs": "createlegMap"}
+  ## attributes the maps are rendered with, the render workers get nothing else of the MapCreator
+  RENDER_SETTINGS = ("size", "simplifyTolerance", "trackStyle", "precision", "photoLayer")
+  ## percentiles of the elevations and speeds that span the colour scale
+  COLOUR_PERCENTILES = (2, 98)
+  ## widths of the thumbnails of the lazy photo layer, the popup picks the smallest that is sharp on screen
+  PHOTO_WIDTHS = (200, 400, 800)
+  ## folder of the thumbnails of the lazy photo layer in the output folder, one subfolder per width
+  THUMBS_DIR = "thumbs"
+  ## folder of new tours if no output is given
+  TOURS_DIR = "./tours"
+  ## size of the cells of the grid index of photos.json in map units
+  PHOTO_GRID_CELL = 100
+  ## script of the lazy photo layer, loads photos.json and only draws the markers of the grid cells in view
+  # cells that are smaller than MIN_CELL_PIXELS on screen are drawn as one marker with the number of pictures,
+  # clicking it spreads the markers of its pictures around it
+  LAZY_PHOTO_SCRIPT = """
+  var MIN_CELL_PIXELS = 48;
+  // radius of the markers of clusters and spread clusters in screen pixels, big enough to tap them
+  var CLUSTER_PIXELS = 10, MARKER_PIXELS = 7;
+  var photoLayer = {data: null, group: null, shown: new Map(), expanded: new Set(), scheduled: false};
+
+  // the page the svg is embedded in, if it is allowed to access it
+  function hostWindow(){
+    try {
+      if (window.frameElement) return window.parent;
+    } catch (e) {}
+    return window;
+  }
+
+  // part of the page on screen in css pixels of the page, pinch zoom moves and scales only the visual viewport
+  function viewport(w){
+    var vv = w.visualViewport;
+    if (vv) return {left: vv.offsetLeft, top: vv.offsetTop, width: vv.width, height: vv.height, zoom: vv.scale};
+    return {left: 0, top: 0, width: w.innerWidth, height: w.innerHeight, zoom: 1};
+  }
+
+  // visible part of the map in map units and the screen pixels per map unit
+  function visibleArea(){
+    var svg = document.documentElement;
+    var host = hostWindow();
+    var view = viewport(host);
+    var left = view.left, top = view.top, right = view.left+view.width, bottom = view.top+view.height;
+    if (host !== window){
+      // the embed element in the page, clipped by the visible part of the page
+      var r = window.frameElement.getBoundingClientRect();
+      left = Math.max(0, left-r.left);
+      top = Math.max(0, top-r.top);
+      right = Math.min(r.width, right-r.left);
+      bottom = Math.min(r.height, bottom-r.top);
+    }
+    var ctm = svg.getScreenCTM();
+    if (!ctm || right <= left || bottom <= top) return null;
+    var inverse = ctm.inverse();
+    var p = svg.createSVGPoint();
+    p.x = left; p.y = top;
+    var a = p.matrixTransform(inverse);
+    p.x = right; p.y = bottom;
+    var b = p.matrixTransform(inverse);
+    // the screen ctm doesn't know about pinch zoom
+    return {x0: Math.min(a.x, b.x), y0: Math.min(a.y, b.y), x1: Math.max(a.x, b.x), y1: Math.max(a.y, b.y), scale: ctm.a*view.zoom};
+  }
+
+  function scheduleUpdate(){
+    if (photoLayer.scheduled) return;
+    photoLayer.scheduled = true;
+    window.requestAnimationFrame(updatePhotos);
+  }
+
+  // draw the grid cells in view, as markers, as cluster or as spread cluster
+  // clusters are sized in screen pixels, so they are drawn again when the zoom changes
+  function updatePhotos(){
+    photoLayer.scheduled = false;
+    var d = photoLayer.data;
+    var v = visibleArea();
+    var wanted = new Map();
+    if (d && v){
+      var cluster = d.cell*v.scale < MIN_CELL_PIXELS;
+      if (!cluster) photoLayer.expanded.clear();
+      var cx0 = Math.max(0, Math.floor(v.x0/d.cell)), cx1 = Math.min(d.cols-1, Math.floor(v.x1/d.cell));
+      var cy0 = Math.max(0, Math.floor(v.y0/d.cell)), cy1 = Math.min(d.rows-1, Math.floor(v.y1/d.cell));
+      for (var cy = cy0; cy <= cy1; cy++){
+        for (var cx = cx0; cx <= cx1; cx++){
+          var key = cy*d.cols+cx;
+          if (!d.grid[key]) continue;
+          if (!cluster) wanted.set(key, "markers");
+          else wanted.set(key, (photoLayer.expanded.has(key) ? "spread " : "cluster ")+v.scale);
+        }
+      }
+    }
+    photoLayer.shown.forEach(function(group, key){
+      if (wanted.get(key) !== group.mode){
+        group.remove();
+        photoLayer.shown.delete(key);
+      }
+    });
+    wanted.forEach(function(mode, key){
+      if (!photoLayer.shown.has(key)){
+        var group;
+        if (mode === "markers") group = drawMarkers(d.grid[key]);
+        else if (photoLayer.expanded.has(key)) group = drawSpread(key, v.scale);
+        else group = drawCluster(key, v.scale);
+        group.mode = mode;
+        photoLayer.shown.set(key, group);
+        photoLayer.group.append(group);
+      }
+    });
+  }
+
+  function svgElement(name, attributes){
+    var element = document.createElementNS("http://www.w3.org/2000/svg", name);
+    for (var attribute in attributes) element.setAttributeNS(null, attribute, attributes[attribute]);
+    return element;
+  }
+
+  function drawMarkers(indices){
+    var group = svgElement("g", {});
+    indices.forEach(function(idx){
+      var p = photoLayer.data.photos[idx];
+      group.append(svgElement("line", {x1: p[2], y1: p[3], x2: p[0], y2: p[1], "stroke-width": 1, stroke: "rgb(10%,10%,100%)"}));
+      var circle = svgElement("circle", {cx: p[0], cy: p[1], r: 5, stroke: "rgb(10%,10%,100%)", fill: "rgb(10%,100%,100%)"});
+      circle.onclick = function(){ show_photo(idx); };
+      group.append(circle);
+    });
+    return group;
+  }
+
+  // centre of the pictures of a grid cell
+  function clusterCentre(indices){
+    var photos = photoLayer.data.photos;
+    var x = 0, y = 0;
+    indices.forEach(function(idx){ x += photos[idx][0]/indices.length; y += photos[idx][1]/indices.length; });
+    return [x, y];
+  }
+
+  // one marker with the number of pictures of the cell, clicking it toggles spreading the markers
+  function drawCluster(key, scale){
+    var indices = photoLayer.data.grid[key];
+    var c = clusterCentre(indices);
+    var r = CLUSTER_PIXELS/scale;
+    var group = svgElement("g", {});
+    var circle = svgElement("circle", {cx: c[0], cy: c[1], r: r, stroke: "rgb(10%,10%,100%)", "stroke-width": 1/scale, fill: "rgb(10%,100%,100%)"});
+    circle.onclick = function(){
+      if (photoLayer.expanded.has(key)) photoLayer.expanded.delete(key);
+      else photoLayer.expanded.add(key);
+      updatePhotos();
+    };
+    group.append(circle);
+    var text = svgElement("text", {x: c[0], y: c[1]+0.35*r, "text-anchor": "middle", "font-size": r, "pointer-events": "none"});
+    text.textContent = indices.length;
+    group.append(text);
+    return group;
+  }
+
+  // the markers of the pictures of a cell on a ring around the cluster, each with a line to where it was taken
+  function drawSpread(key, scale){
+    var d = photoLayer.data;
+    var indices = d.grid[key];
+    var c = clusterCentre(indices);
+    // the markers on the ring don't overlap
+    var radius = Math.max(3*CLUSTER_PIXELS, indices.length*2.5*MARKER_PIXELS/(2*Math.PI))/scale;
+    var group = svgElement("g", {});
+    indices.forEach(function(idx, i){
+      var p = d.photos[idx];
+      var angle = 2*Math.PI*i/indices.length;
+      var x = c[0]+radius*Math.cos(angle), y = c[1]+radius*Math.sin(angle);
+      group.append(svgElement("line", {x1: x, y1: y, x2: p[0], y2: p[1], "stroke-width": 1/scale, stroke: "rgb(10%,10%,100%)"}));
+      var circle = svgElement("circle", {cx: x, cy: y, r: MARKER_PIXELS/scale, stroke: "rgb(10%,10%,100%)", "stroke-width": 1/scale, fill: "rgb(10%,100%,100%)"});
+      circle.onclick = function(){ show_photo(idx); };
+      group.append(circle);
+    });
+    // clicking the cluster again folds the markers
+    group.append(drawCluster(key, scale));
+    return group;
+  }
+
+  // show a picture in the smallest thumbnail that is sharp at the current zoom
+  function show_photo(idx){
+    var d = photoLayer.data;
+    var p = d.photos[idx];
+    var v = visibleArea();
+    var pixels = d.popup*(v ? v.scale : 1)*(window.devicePixelRatio || 1);
+    var src = p[4];
+    for (var i = 0; i < d.widths.length; i++){
+      if (d.widths[i] >= pixels){
+        src = "thumbs/"+d.widths[i]+"/"+p[4];
+        break;
+      }
+    }
+    var x = Math.min(p[2], d.size[1]-d.popup), y = Math.min(p[3], d.size[0]-d.popup);
+    show_image(src, d.popup, d.popup, "image "+p[4], x, y);
+  }
+
+  function loadPhotos(){
+    fetch("photos.json").then(function(response){ return response.json(); }).then(function(data){
+      photoLayer.data = data;
+      photoLayer.group = svgElement("g", {id: "photos"});
+      document.documentElement.append(photoLayer.group);
+      var host = hostWindow();
+      [window, host].forEach(function(w){
+        w.addEventListener("scroll", scheduleUpdate, {passive: true});
+        w.addEventListener("resize", scheduleUpdate);
+      });
+      if (host.visualViewport){
+        host.visualViewport.addEventListener("resize", scheduleUpdate);
+        host.visualViewport.addEventListener("scroll", scheduleUpdate);
+      }
+      updatePhotos();
+    });
+  }
+  loadPhotos();
+  """
+  ## colours of the legs
+  LEGCOLORS = [[0,0,0],[255,0,0],[0,255,0],[0,0,255],[120,120,0],[255,0,255]]
+
   def __init__(self) -> None:
     # lat / long
     self.topleft=[47.3616,11.3420]
@@ -83,54 +1406,131 @@ class MapCreator:
     self.margin = 0.005
     # whether to shrink the images
     self.shrink = False
+    # offset of local time to UTC in hours
+    self.tzOffset = 2
+    # max time in s between a picture and the closest segment
+    self.photoTolerance = 60
+    # number of processes for the pictures, None for one per cpu
+    self.imageJobs = None
+    # whether to generate all files, even if their inputs didn't change
+    self.force = False
+    # number of processes rendering the maps
+    self.renderJobs = len(self.MAPS)
+    # max deviation of the drawn track from the recorded one
+    self.simplifyTolerance = 0.5
+    # how the track is drawn, "path" or "lines"
+    self.trackStyle = "path"
+    # number of points the elevation and speed are averaged over
+    self.smoothWindow = 5
+    # how the pictures are shown on the picture map, "inline" or "lazy"
+    self.photoLayer = "inline"
+    # decimals of the coordinates of track paths
+    self.precision = 1
     # name of the tour from gpx file
     self.tourname = ""
+    # result of the last gpx read, so the file is only parsed once
+    self.gpxFile = None
+    self.gpxContent = None
+    # hashes of the gpx files by path, so every file is only hashed once
+    self.gpxHashes = {}
+    # hashes of the inputs of the tour, computed once by isUpToDate or renderTour
+    self.buildInputs = None
+    # folder of the track cache, next to the cfg.json of the tour
+    self.cacheDir = None
+    # index of the pictures shared by several tours, None to scan the image folder
+    self.photoIndex = None
+    # timestamps of the pictures, created on first use with the zone of the tour
+    self.photoTimestamps = None
+    # folder of new tours if no output is given
+    self.toursDir = self.TOURS_DIR
+    # timings of the stages of the tour, only recorded with --profile
+    self.stats = BuildStats()
+    # source of the maps of new tours
+    self.mapProvider = ManualMapProvider()
+    # cache of the maps of all tours, None to always ask the map provider
+    self.mapCache = None
+
+  ##
+  # read the gpx file once and keep the result for the name and the track points
+  def readGpx(self, gpxData):
+    if self.gpxFile != gpxData or self.gpxContent is None:
+      with self.stats.stage("parse") as counts:
+        self.gpxContent = GpxReader(TimestampDecoder(self.tzOffset)).read(gpxData)
+        counts["points"] = len(self.gpxContent[2])
+      self.gpxFile = gpxData
+    return self.gpxContent
+
+  ##
+  # hash of the gpx file, computed once per file
+  def getGpxHash(self, gpxData):
+    if gpxData not in self.gpxHashes:
+      self.gpxHashes[gpxData] = fileHash(gpxData)
+    return self.gpxHashes[gpxData]
 
   def getTrackName(self, gpxData):
-    ns = {"":"http://www.topografix.com/GPX/1/1"}
-    tree = ET.parse(gpxData)
+    # the name is known without reading the gpx file if it is cached
+    if self.cacheDir is not None and (self.gpxContent is None or self.gpxFile != gpxData):
+      meta = TrackCache(self.cacheDir).loadMeta()
+      if meta is not None and meta.get("gpxHash") == self.getGpxHash(gpxData):
+        return meta["name"]
+    name, _, _ = self.readGpx(gpxData)
+    return name
+
+  ##
+  # size of the map, [height, width]
+  def readMapSize(self, mapFile):
+    tree = ET.parse(mapFile)
     root = tree.getroot()
-    return root.find("trk", namespaces=ns).find("name", namespaces=ns).text
+    return [int(root.get("height").replace("pt","")), int(root.get("width").replace("pt",""))]
+
+  ##
+  # restore the state of getMapLink from the meta data of the track cache
+  def restoreCachedTrack(self, meta):
+    self.topleft = meta["topleft"]
+    self.botright = meta["botright"]
+    self.scaling = meta["scaling"]
+    self.mapCenter = meta["mapCenter"]
+
+  ##
+  # store the parsed and scaled track in the track cache
+  def cacheTrack(self, gpxData, gpxHash, track:Track):
+    meta = {
+      "gpxHash": gpxHash,
+      "name": self.getTrackName(gpxData),
+      "topleft": self.topleft,
+      "botright": self.botright,
+      "scaling": self.scaling,
+      "mapCenter": self.mapCenter,
+    }
+    try:
+      TrackCache(self.cacheDir).save(TrackCache.key(gpxHash, self.margin, self.size, self.tzOffset), meta, track)
+    except OSError as ex:
+      # the cache is only an optimization
+      print("could not store the track cache:", ex)
 
   ##
   # parse track points
   def parsetrkpoints(self, gpxData):
-    waypoints=[]
-    trackpoints=[]
-    ns = {"":"http://www.topografix.com/GPX/1/1"}
-    tree = ET.parse(gpxData)
-    root = tree.getroot()
-    for wpt in root.findall('wpt',namespaces=ns):
-      waypoints.append(wypnt(wpt.get("lat"),wpt.get("lon"), wpt.find("ele", namespaces=ns).text,wpt.find("time", namespaces=ns).text,wpt.find("desc", namespaces=ns).text))
-      #print(wypnt(wpt.get("lat"),wpt.get("lon"), wpt.find("ele", namespaces=ns).text,wpt.find("time", namespaces=ns).text,wpt.find("desc", namespaces=ns).text))
-    
-    for tpt in root.find("trk", namespaces=ns).find("trkseg", namespaces=ns).findall('trkpt', namespaces=ns):
-      trackpoints.append(trkpnt(tpt.get("lat"),tpt.get("lon"), tpt.find("ele", namespaces=ns).text,tpt.find("time", namespaces=ns).text))
-    
-    return waypoints, trackpoints
+    _, waypoints, track = self.readGpx(gpxData)
+    return waypoints, track
 
   ##
-  # get a segment from the list of segments based on the timestamp  
-  def getSegment(self, segments:List[Segment], timestamp):
-    # TODO segments are sorted by time -> binary search? 
-    if (timestamp==None):
-      return None
-    for segment in segments:
-      if (segment.orig.timestamp<timestamp and segment.target.timestamp> timestamp):
-        return segment
-    return None
+  # get the indices of the segments of the track based on the timestamps (ns), None if there is no segment
+  def getSegments(self, track:Track, timestamps):
+    known = [i for i, timestamp in enumerate(timestamps) if timestamp is not None]
+    found = SegmentTimeIndex(track).lookup([timestamps[i] for i in known], self.photoTolerance)
+    segments = [None]*len(timestamps)
+    for i, segment in zip(known, found.tolist()):
+      if segment >= 0:
+        segments[i] = segment
+    return segments
 
   ##
-  # gets a map link for the given track points
-  def getMapLink(self, trps:List[trkpnt]):
+  # gets a map link for the given track
+  def getMapLink(self, track:Track):
     # get min & max long/lat from track points
-    minlat, minlong = 360, 360 
-    maxlat, maxlong = -360, -360
-    for trp in trps:
-      minlat = min(minlat, trp.lat)
-      minlong = min(minlong, trp.lon)
-      maxlat = max(maxlat, trp.lat)
-      maxlong = max(maxlong, trp.lon)
+    minlat, minlong = float(track.lat.min()), float(track.lon.min())
+    maxlat, maxlong = float(track.lat.max()), float(track.lon.max())
     
     # do scaling based on min/max values
     # TODO better scaling based on size?
@@ -149,15 +1549,62 @@ class MapCreator:
     # build url for streetmap
     return "https://render.openstreetmap.org/cgi-bin/export?bbox={botleftlong:.15f},{botleftlat:.15f},{toprightlong:.15f},{toprightlat:.15f}&scale={scale}&format=svg ".format(botleftlong=minlong, botleftlat=minlat, toprightlong=maxlong, toprightlat=maxlat, scale=round(scale))
 
-  def createImageMap(self, map, pnts:List[trkpnt], segments:List[Segment], imageFolder, out):
-    print("creating picture map")
+  ##
+  # find the pictures taken on the track, returns a list of (segment, file name, path)
+  def matchPictures(self, track:Track, imageFolder):
+    try:
+      with self.stats.stage("matchPictures") as counts:
+        images = self.findTourImages(imageFolder, track)
+        # resolve all pictures at once
+        segments = self.getSegments(track, [timestamp for _, _, timestamp in images])
+        counts["photos"] = len(images)
+        counts["matched"] = len(images)-segments.count(None)
+      print("pictures without matching segment: ", segments.count(None))
+      return [(segment, f, os.path.join(root, f)) for (root, f, _), segment in zip(images, segments) if segment != None]
+    except Exception as ex:
+      print(ex)
+      return []
+
+  ##
+  # pictures for the tour as (folder, file name, time in ns), time is None if unknown
+  # with a photo index only the pictures of the time range of the track are returned
+  def findTourImages(self, imageFolder, track:Track=None):
+    if self.photoIndex is not None and track is not None:
+      tolerance = int(self.photoTolerance*1e9)
+      return self.photoIndex.between(int(track.time.min())-tolerance, int(track.time.max())+tolerance)
+    images = []
+    for root, f in findImages(imageFolder):
+      timestamp = self.getTimestamp(os.path.join(root, f))
+      images.append((root, f, toEpochNs(timestamp) if timestamp is not None else None))
+    if self.photoTimestamps is not None:
+      self.photoTimestamps.save()
+    return images
+
+  ##
+  # copy or shrink the pictures into the output folder
+  def processPictures(self, pictures, out):
+    if self.recreate:
+      return
     print("shrinking images: ", self.shrink)
+    try:
+      with self.stats.stage("processPictures", photos=len(pictures)):
+        images = [(src, f) for _, f, src in pictures]
+        ImageStage(out, self.shrink, workers=self.imageJobs).process(images)
+        if self.photoLayer == "lazy":
+          # the thumbnails the lazy photo layer picks from, one folder per width
+          for width in self.PHOTO_WIDTHS:
+            os.makedirs(os.path.join(out, self.THUMBS_DIR, str(width)), exist_ok=True)
+            ImageStage(os.path.join(out, self.THUMBS_DIR, str(width)), True, size=(width, width), workers=self.imageJobs).process(images)
+    except Exception as ex:
+      print(ex)
+
+  def createImageMap(self, data:RenderData, out):
+    print("creating picture map")
     self.buffer = []
     dwg = svgwrite.Drawing(os.path.join(out,'picture.svg'),  viewBox=('0 0 {y} {x}'.format(x=self.size[0], y=self.size[1])))
-    for segment in segments: 
-      dwg.add(dwg.line((segment.orig.scaledlon,segment.orig.scaledlat),(segment.target.scaledlon,segment.target.scaledlat),stroke_width="2",stroke=svgwrite.rgb(10, 10, 10, '%')))
-      # TODO opening/closing images does strange things on chrome/edge
-      contentscript = """
+    self.drawTrack(dwg, data.track, data.kept["picture"], data.colours["picture"])
+    # TODO opening/closing images does strange things on chrome/edge
+    contentscript = """
   // shows an image from source
   function show_image(src, width, height, alt, x, y) 
   {
@@ -190,27 +1637,40 @@ class MapCreator:
       init();
       """  
     dwg.add(svgwrite.container.Script(content=initscript))
-    try:
-      for root, dirs, files in os.walk(imageFolder):
-        for f in files:
-          if "jpg" in f:
-            segment = self.getSegment(segments, self.getTimestamp(f))
-            if (segment != None):
-              self.addImageCircleToBuffer( dwg, segment, f)
-              if (not self.recreate and self.shrink):
-                image = Image.open(os.path.join(root, f))
-                image.thumbnail((400,300))
-                image.save(os.path.join(out, f))
-              else:
-                if not self.recreate:
-                  shutil.copyfile(os.path.join(root, f), os.path.join(out, f))
-    except Exception as ex:
-      print(ex)
-    self.addBufferedImageCircles(dwg)
+    if self.photoLayer == "lazy":
+      self.writePhotoIndex(data, out)
+      dwg.add(svgwrite.container.Script(content=self.LAZY_PHOTO_SCRIPT))
+    else:
+      for segment, f in data.pictures:
+        self.addImageCircleToBuffer( dwg, data.track, segment, f)
+      self.addBufferedImageCircles(dwg)
     dwg.save()
 
-  def addImageCircleToBuffer(self, dwg:svgwrite.Drawing, segment:Segment, f:str):
-    center=((segment.orig.scaledlon+segment.target.scaledlon)/2,(segment.orig.scaledlat+segment.target.scaledlat)/2)
+  ##
+  # write the pictures of the lazy photo layer to photos.json
+  # every picture is [x, y, original x, original y, file name], the grid maps cells to the pictures in them
+  def writePhotoIndex(self, data:RenderData, out):
+    origins = [data.track.segmentCenter(segment) for segment, _ in data.pictures]
+    layout = MarkerLayout(self.size)
+    centers = layout.resolve(list(origins))
+    self.markerLayout = layout
+    print("marker layout: {iterations} passes, {overlaps} overlaps left".format(iterations=layout.iterations, overlaps=layout.residualOverlaps))
+    cell = self.PHOTO_GRID_CELL
+    cols = max(math.ceil(self.size[1]/cell), 1)
+    rows = max(math.ceil(self.size[0]/cell), 1)
+    photos = []
+    grid = {}
+    for idx, ((_, f), orig, center) in enumerate(zip(data.pictures, origins, centers)):
+      photos.append([round(center[0], self.precision), round(center[1], self.precision), round(orig[0], self.precision), round(orig[1], self.precision), f])
+      cx = min(max(int(center[0]//cell), 0), cols-1)
+      cy = min(max(int(center[1]//cell), 0), rows-1)
+      grid.setdefault(cy*cols+cx, []).append(idx)
+    index = {"size": self.size, "cell": cell, "cols": cols, "rows": rows, "popup": 400, "widths": list(self.PHOTO_WIDTHS), "photos": photos, "grid": grid}
+    with open(os.path.join(out, "photos.json"), "w") as f:
+      json.dump(index, f, separators=(",", ":"))
+
+  def addImageCircleToBuffer(self, dwg:svgwrite.Drawing, track:Track, segment:int, f:str):
+    center=track.segmentCenter(segment)
     # store the segment, file and center info
     self.buffer.append([segment, f, center, center])
     # add a circle to the original position
@@ -220,52 +1680,14 @@ class MapCreator:
         r=2,stroke=svgwrite.rgb(255,10,10,"%")))
     
   def addBufferedImageCircles(self, dwg:svgwrite.Drawing):
-    collissionFree = False
     # radius of image circle
     R=5
-    # max loop counter
-    counter = 0
-    # factor to move circles away from each other
-    movefac=10
-    # distance between circles to consider them overlapping
-    overlapdist = 8
-    # while there are collissions
-    while not collissionFree:
-      centers=[]
-      collissionFree=True
-      # all image circles
-      for idx, buf in enumerate(self.buffer):
-        segment, f, center, orig = buf
-        cnt=0
-        for c, id,i  in centers:
-          # calc distance between points
-          d = math.sqrt(((c[0]-center[0])**2+(c[1]-center[1])**2))
-          # if overlapping and distance > 0 (otherwise div0)
-          if d<=overlapdist and d>0:
-            # calc new x, y
-            x = center[0]-(c[0]-center[0])/d*movefac
-            y = center[1]-(c[1]-center[1])/d*movefac
-            # limits for image size
-            x = min(max(x,overlapdist),self.size[1]-overlapdist)
-            y = min(max(y,overlapdist),self.size[0]-overlapdist)
-            # update in buffer
-            self.buffer[idx][2]=(x, y)
-            # also move already checked circle
-            x = c[0]+(c[0]-center[0])/d*movefac
-            y = c[1]+(c[1]-center[1])/d*movefac
-            x = min(max(x,overlapdist),self.size[1]-overlapdist)
-            y = min(max(y,overlapdist),self.size[0]-overlapdist)
-            # and update
-            self.buffer[id][2]=(x, y)
-            centers[i][0]=(x,y)
-            # we had a collission
-            collissionFree=False
-        centers.append([center, idx, cnt])
-        cnt =cnt +1
-      counter = counter +1
-      # max 100 loops
-      if counter > 100:
-        collissionFree = True
+    layout = MarkerLayout(self.size)
+    centers = layout.resolve([buf[2] for buf in self.buffer])
+    for buf, center in zip(self.buffer, centers):
+      buf[2] = center
+    self.markerLayout = layout
+    print("marker layout: {iterations} passes, {overlaps} overlaps left".format(iterations=layout.iterations, overlaps=layout.residualOverlaps))
     # finally add all buffered and moved circles
     for idx, buf in enumerate(self.buffer):
       segment, f, center, orig = buf
@@ -275,12 +1697,11 @@ class MapCreator:
           center=center,
           r=R,stroke=svgwrite.rgb(10,10,255,"%"),  
           fill=svgwrite.rgb(10,255,255,"%"),             
-          onclick=self.getShowImageCall(f, segment)))
+          onclick=self.getShowImageCall(f, orig)))
 
 
-  def getShowImageCall(self, f, segment:Segment):
-    x=(segment.orig.scaledlon+segment.target.scaledlon)/2
-    y=(segment.orig.scaledlat+segment.target.scaledlat)/2
+  def getShowImageCall(self, f, center):
+    x, y = center
     imageSize=[400, 400]
     if x+imageSize[1]>self.size[1]:
       x = self.size[1]-imageSize[1]
@@ -288,46 +1709,46 @@ class MapCreator:
       y = self.size[0]-imageSize[0]
     return "show_image(\""+f+"\", "+str(imageSize[0])+", "+str(imageSize[1])+", 'image "+f+"',"+ str(x)+","+ str(y)+")"
   
-  def createEleMap(self, map, pnts:List[trkpnt], segments:List[Segment], out):
+  def createEleMap(self, data:RenderData, out):
     print("creating elevation map")
     dwg = svgwrite.Drawing(os.path.join(out,'elevation.svg'), viewBox=('0 0 {y} {x}'.format(x=self.size[0], y=self.size[1])))
-    minele = 100000
-    maxele = 0 
-    for segment in segments:
-      if (segment.avele>00):
-        minele = min(minele,segment.avele)
-        maxele = max(maxele,segment.avele)
-    for segment in segments:
-      dwg.add(dwg.line((segment.orig.scaledlon,segment.orig.scaledlat),(segment.target.scaledlon,segment.target.scaledlat),stroke_width="2",stroke=self.getColorForElevation(segment.avele, minele, maxele)))
+    minele, maxele = data.ranges["elevation"]
+    self.drawTrack(dwg, data.track, data.kept["elevation"], data.colours["elevation"])
     # TODO add mouse over event on track (show height)
     i =0
     # TODO legend as mouse over to not block map & have light grey background?
-    for x in range(int(minele), int(maxele), int((maxele-minele)/5)):
+    for x in self.legendValues(minele, maxele):
       dwg.add(dwg.line((5,10+i*20),(20,10+i*20),stroke_width="3",stroke=self.getColorForElevation(x, minele, maxele)))
       dwg.add(dwg.text(f"{x} m",insert=(25, 14+i*20)))
       i=i+1
     dwg.save()
   
+  ##
+  # values of the legend entries, about five steps from min to max
+  def legendValues(self, minvalue, maxvalue):
+    return range(int(minvalue), int(maxvalue), max(int((maxvalue-minvalue)/5), 1))
+
   def getColorForElevation(self, ele, minele, maxele):
     # TODO more complex color scheme?
     return svgwrite.rgb(min(255,(ele-minele)*255/(maxele-minele)),max(255-(ele-minele)*255/(maxele-minele),0), 0, '%')
 
+  ##
+  # packed colours for an array of elevations, same scheme as getColorForElevation
+  def getColorsForElevation(self, ele, minele, maxele):
+    with np.errstate(divide="ignore", invalid="ignore"):
+      scaled = (ele-minele)*255/(maxele-minele)
+    return packColours(scaled, 255-scaled, 0)
+
 
-  def createSpeedMap(self, map, pnts:List[trkpnt], segments:List[Segment], out):
+  def createSpeedMap(self, data:RenderData, out):
     print("creating speed map")
     dwg = svgwrite.Drawing(os.path.join(out,'speed.svg'), viewBox=('0 0 {y} {x}'.format(x=self.size[0], y=self.size[1])))
-    minspeed = 100000
-    maxspeed = 0 
-    for segment in segments:
-      if segment.speed<200:
-        minspeed = min(minspeed,segment.speed)
-        maxspeed = max(maxspeed,segment.speed)
-    for segment in segments:
-      dwg.add(dwg.line((segment.orig.scaledlon,segment.orig.scaledlat),(segment.target.scaledlon,segment.target.scaledlat),stroke_width="2",stroke=self.getColorForSpeed(segment.speed, minspeed, maxspeed)))
-      # TODO add mouse over event on track (show speed)
+    minspeed, maxspeed = data.ranges["speed"]
+    self.drawTrack(dwg, data.track, data.kept["speed"], data.colours["speed"])
+    # TODO add mouse over event on track (show speed)
     i=0
     # TODO legend as mouse over to not block map & have light grey background?
-    for x in range(int(minspeed), int(maxspeed), int((maxspeed-minspeed)/5)):
+    for x in self.legendValues(minspeed, maxspeed):
       dwg.add(dwg.line((5,10+i*20),(20,10+i*20),stroke_width="3",stroke=self.getColorForSpeed(x, minspeed, maxspeed)))
       dwg.add(dwg.text(f"{x/100} m/s",insert=(25, 14+i*20)))
       i=i+1
@@ -335,157 +1756,495 @@ class MapCreator:
 
   def getColorForSpeed(self, speed, minspeed, maxspeed):
     # TODO more complex color scheme?
-    return svgwrite.rgb(max(255-speed*255/(maxspeed-minspeed),0),min(255,speed*255/(maxspeed-minspeed)), 0, '%')
+    return svgwrite.rgb(max(255-(speed-minspeed)*255/(maxspeed-minspeed),0),min(255,(speed-minspeed)*255/(maxspeed-minspeed)), 0, '%')
+
+  ##
+  # packed colours for an array of speeds, same scheme as getColorForSpeed
+  def getColorsForSpeed(self, speed, minspeed, maxspeed):
+    with np.errstate(divide="ignore", invalid="ignore"):
+      scaled = (speed-minspeed)*255/(maxspeed-minspeed)
+    return packColours(255-scaled, scaled, 0)
 
-  def createlegMap(self, map, pnts:List[trkpnt], segments:List[Segment], out):
+  def createlegMap(self, data:RenderData, out):
     print("creating leg map")
     dwg = svgwrite.Drawing(os.path.join(out,'legs.svg'), viewBox=('0 0 {y} {x}'.format(x=self.size[0], y=self.size[1])))
-    legcount = 0
-    legcolor = [[0,0,0],[255,0,0],[0,255,0],[0,0,255],[120,120,0],[255,0,255]]
-    legdates=[]
-    legdates.append(segments[0].orig.date)
-    for segment in segments:
-      if (segment.time>3000):
-        legcount=legcount+1
-        if not segment.target.date in legdates:
-          legdates.append(segment.target.date)
-      dwg.add(dwg.line((segment.orig.scaledlon,segment.orig.scaledlat),(segment.target.scaledlon,segment.target.scaledlat),stroke_width="2",stroke=svgwrite.rgb(legcolor[legcount%6][0],legcolor[legcount%6][1],legcolor[legcount%6][2] , '%')))
+    legcolor = self.LEGCOLORS
+    legdates = data.legdates
+    self.drawTrack(dwg, data.track, data.kept["legs"], data.colours["legs"])
     
     # TODO legend as mouse over to not block map & have light grey background?
-    for i in range (0, legcount+1):
+    for i in range (0, len(legdates)):
       dwg.add(dwg.line((5,10+i*20),(20,10+i*20),stroke_width="3",stroke=svgwrite.rgb(legcolor[i%6][0],legcolor[i%6][1],legcolor[i%6][2] , '%')))
       dwg.add(dwg.text(f"{legdates[i]}",insert=(25, 14+i*20)))
     dwg.save()   
+
+  ##
+  # compute everything the maps need in one pass over the track, only for the given maps
+  def prepareRenderData(self, track:Track, pictures, maps):
+    data = RenderData(track, self.size)
+    data.pictures = pictures
+    # smoothed values and their colour scales
+    elevation = rollingMean(track.avele, self.smoothWindow)
+    speed = rollingMean(track.speed, self.smoothWindow)
+    minele, maxele = percentileRange(elevation, *self.COLOUR_PERCENTILES)
+    data.ranges["elevation"] = (minele, maxele)
+    minspeed, maxspeed = percentileRange(speed, *self.COLOUR_PERCENTILES)
+    data.ranges["speed"] = (minspeed, maxspeed)
+    # a long break starts a new leg
+    breaks = track.duration>Track.LEG_BREAK
+    data.legdates.append(track.date(0))
+    for i in np.flatnonzero(breaks).tolist():
+      # one legend entry per leg, several legs can be on the same day
+      data.legdates.append(track.date(i+1))
+    # segment colours of every map
+    for name in maps:
+      if name == "picture":
+        colours = np.full(track.segmentCount(), packColours(10, 10, 10))
+      elif name == "elevation":
+        colours = self.getColorsForElevation(elevation, minele, maxele)
+      elif name == "speed":
+        colours = self.getColorsForSpeed(speed, minspeed, maxspeed)
+      elif name == "legs":
+        palette = np.array(self.LEGCOLORS)
+        legs = np.cumsum(breaks)%6
+        colours = packColours(palette[legs,0], palette[legs,1], palette[legs,2])
+      data.colours[name] = colours
+    return data
     
+  ##
+  # simplify the track for a map, colours are the packed colours of the segments
+  def simplify(self, name, track:Track, colours):
+    kept = simplifyLine(track.x, track.y, self.simplifyTolerance, colours)
+    print("simplified {name}: removed {removed} of {count} points".format(name=name, removed=len(track)-len(kept), count=len(track)))
+    return kept
+
+  ##
+  # draw the kept points of the track, every segment gets the colour of the first recorded segment it covers
+  def drawTrack(self, dwg:svgwrite.Drawing, track:Track, kept, colours):
+    if self.trackStyle == "lines":
+      x, y = track.x.tolist(), track.y.tolist()
+      colours = colours.tolist()
+      kept = kept.tolist()
+      for a, b in zip(kept[:-1], kept[1:]):
+        dwg.add(dwg.line((x[a],y[a]),(x[b],y[b]),stroke_width="2",stroke=colourString(colours[a])))
+      return
+    if len(kept) < 2:
+      return
+    # one path per run of consecutive segments with the same colour
+    runColours = colours[kept[:-1]]
+    starts = np.flatnonzero(np.r_[True, runColours[1:] != runColours[:-1]])
+    ends = np.r_[starts[1:], len(runColours)]
+    x = [self.formatCoordinate(v) for v in track.x[kept].tolist()]
+    y = [self.formatCoordinate(v) for v in track.y[kept].tolist()]
+    for start, end, colour in zip(starts.tolist(), ends.tolist(), runColours[starts].tolist()):
+      d = "M" + x[start] + " " + y[start] + "L" + " ".join(x[i] + " " + y[i] for i in range(start+1, end+1))
+      dwg.add(dwg.path(d=d, fill="none", stroke_width="2", stroke_linejoin="round", stroke=colourString(colour)))
+
+  ##
+  # shortest representation of a coordinate with the configured precision
+  def formatCoordinate(self, value):
+    text = "{value:.{precision}f}".format(value=value, precision=self.precision)
+    if "." in text:
+      text = text.rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
   def createMaps(self, args,  gpxData, imageFolder, out, cfg:Config):
-    pnts, trps = self.parsetrkpoints(gpxData)
-    url = self.getMapLink(trps)
-    targetMap = os.path.join(out, "map.svg")
-    # manual intervention neccessary, OSM doesn't like getting it via code
-    if not self.recreate:
-      print("download file and place the resulting file as map.svg in the working dir:")
-      print(url)
-      print("you might need to download any map manually first for openstreetmap to accept the link")
-      input("press enter once done")
+    with self.stats.stage("createMaps"):
+      self.buildMaps(args, gpxData, imageFolder, out, cfg)
 
+  ##
+  # get the scaled track from the cache or the gpx file and the map, then render the tour
+  def buildMaps(self, args,  gpxData, imageFolder, out, cfg:Config):
+    targetMap = os.path.join(out, "map.svg")
+    gpxHash = self.getGpxHash(gpxData)
+    if self.recreate:
+      # the map is already there, so the scaled track can come from the cache
+      self.size = self.readMapSize(targetMap)
+      with self.stats.stage("loadCache"):
+        cached = TrackCache(self.cacheDir).load(TrackCache.key(gpxHash, self.margin, self.size, self.tzOffset))
+      if cached is not None:
+        print("using cached track")
+        meta, track = cached
+        self.restoreCachedTrack(meta)
+        self.renderTour(args, gpxData, imageFolder, out, cfg, track)
+        return
+    # the waypoints aren't drawn on any map
+    _, track = self.parsetrkpoints(gpxData)
+    url = self.getMapLink(track)
+    if self.recreate:
+      # the map may cover more than the track if it came from the map cache
+      request = MapRequest.load(os.path.join(out, "map.json"))
+      if request is not None:
+        self.setMapBounds(request)
+    else:
       if not os.path.exists(out):
         os.makedirs(out)
-      shutil.copyfile("map.svg", targetMap)
+      with self.stats.stage("acquireMap"):
+        self.acquireMap(url, targetMap)
       shutil.copyfile(gpxData, os.path.join(out, os.path.basename(gpxData)))
       cfg.creationDate=datetime.today().strftime('%Y-%m-%d')
       with open(os.path.join(out, "cfg.json"),"w") as f:
           f.write(json.dumps(cfg.__dict__))
-    tree = ET.parse(targetMap)
-    root = tree.getroot()
-    self.size = [int(root.get("height").replace("pt","")), int(root.get("width").replace("pt",""))]
+    self.size = self.readMapSize(targetMap)
     print ("map size: ", self.size)
-    map = svgwrite.image.Image("map.svg",insert=(0,0), size=(self.size[1],self.size[0]))
-    # scale all trackpoints to the map
-    trps = [trp for trp in trps if trp.scale(self.topleft, self.botright, self.size)]
-    
-    segments=[]
-    for i in range (0, len(trps)-1):
-      segments.append(Segment(trps[i],trps[i+1]))
-  
-    self.createPage(args, out, cfg)
-    self.createImageMap(map, pnts, segments, imageFolder, out)
-    self.createEleMap(map, pnts, segments, out)
-    self.createSpeedMap(map, pnts, segments, out)
-    self.createlegMap(map, pnts, segments, out)
-
-  def createPage(self, args, out, cfg:Config):
-    if not args.createJekyllMd:
-      lines = open("template.html","r", encoding="utf-8").readlines()
-      newLines = []
-      for line in lines:
-        line = line.replace("{{TOURTITLE}}",self.tourname)
-        line = line.replace("{{MAP_DATE}}",cfg.creationDate)
-        line = line.replace("{{CREATION_DATE}}",datetime.today().strftime('%Y-%m-%d'))
-        line = line.replace("{{COORDINATES}}",self.mapCenter)
-        newLines.append(line)
-      open(os.path.join(out,"index.html"),"w", encoding="utf-8").writelines(newLines)
-    else :
-      lines = open("jekyll_template.md","r", encoding="utf-8").readlines()
-      newLines = []
-      for line in lines:
-        line = line.replace("{{TOURTITLE}}",self.tourname)
-        line = line.replace("{{MAP_DATE}}",cfg.creationDate)
-        line = line.replace("{{CREATION_DATE}}",datetime.today().strftime('%Y-%m-%d'))
-        line = line.replace("{{COORDINATES}}",self.mapCenter)
-        newLines.append(line.encode())
-      open(os.path.join(out,"index.md"),"bw").writelines(newLines)
-
-
-  # get the timestamp of the filename  
-  def getTimestamp(self, name):
-    try:
-      return datetime.strptime(name,'%Y%m%d_%H%M%S.jpg')
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'IMG_%Y%m%d_%H%M%S_%f.jpg')
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'MVIMG_%Y%m%d_%H%M%S_%f.jpg')
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'PXL_%Y%m%d_%H%M%S%f.MP.jpg') + timedelta(hours=2, minutes=0)
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'PXL_%Y%m%d_%H%M%S%f.jpg')+timedelta(hours=2, minutes=0)
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'PXL_%Y%m%d_%H%M%S%f.LONG_EXPOSURE-01.COVER.jpg')+timedelta(hours=2, minutes=0)
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'PXL_%Y%m%d_%H%M%S%f.RAW-01.COVER.jpg')+timedelta(hours=2, minutes=0)
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'PXL_%Y%m%d_%H%M%S%f.NIGHT.jpg')+timedelta(hours=2, minutes=0)
-    except :
-      pass
-    try:
-      return datetime.strptime(name,'PXL_%Y%m%d_%H%M%S%f.PANO.jpg')+timedelta(hours=2, minutes=0)
-    except:
-      print ("could not match date of image name:", name)
+    # scale the whole track to the map
+    with self.stats.stage("scale", points=len(track)):
+      track.scale(self.topleft, self.botright, self.size)
+    self.cacheTrack(gpxData, gpxHash, track)
+    self.renderTour(args, gpxData, imageFolder, out, cfg, track)
+
+  ##
+  # get the map of the current bounds into target, from the map cache or the map provider
+  # the bounds are widened to the map that is used, the request is stored next to it as map.json
+  def acquireMap(self, url, target):
+    request = MapRequest([self.topleft[1], self.botright[0], self.botright[1], self.topleft[0]], self.scaling, url)
+    cached = self.mapCache.find(request) if self.mapCache is not None else None
+    if cached is not None:
+      path, request = cached
+      print("using cached map " + request.key())
+      shutil.copyfile(path, target)
+    else:
+      self.mapProvider.fetch(request, target)
+      if self.mapCache is not None:
+        try:
+          self.mapCache.store(request, target)
+        except OSError as ex:
+          # the cache is only an optimization
+          print("could not store the map in the map cache:", ex)
+    self.setMapBounds(request)
+    with open(os.path.join(os.path.dirname(target), "map.json"), "w") as f:
+      json.dump(request.toJson(), f)
+
+  def setMapBounds(self, request:MapRequest):
+    minlong, minlat, maxlong, maxlat = request.bbox
+    self.botright = [minlat, maxlong]
+    self.topleft = [maxlat, minlong]
+
+  ##
+  # generate the page and the maps of the scaled track
+  def renderTour(self, args, gpxData, imageFolder, out, cfg:Config, track:Track):
+    # only generate the files whose inputs changed, isUpToDate may have computed the inputs already
+    if self.buildInputs is None:
+      self.buildInputs = self.getBuildInputs(args, gpxData, imageFolder, out, cfg, track)
+    inputs = self.buildInputs
+    manifest = BuildManifest(out)
+    stale = [name for name in inputs if self.force or not manifest.isUpToDate(name, inputs[name])]
+    print("unchanged: ", [name for name in inputs if name not in stale])
+    maps = [name for name in self.MAPS if name+".svg" in stale or (name == "picture" and "photos.json" in stale)]
+    # the page shows the number of pictures as well
+    pictures = self.matchPictures(track, imageFolder) if "picture" in maps or self.getPageName(args) in stale else []
+    stats = track.stats(self.smoothWindow)
+    if self.getPageName(args) in stale:
+      self.createPage(args, out, cfg, stats, len(pictures))
+    if "stats.json" in stale:
+      self.writeStats(stats, out)
+    if "picture" not in maps:
+      pictures = []
+    with self.stats.stage("prepareRenderData", segments=track.segmentCount()):
+      data = self.prepareRenderData(track, [(segment, f) for segment, f, _ in pictures], maps)
+    self.renderMaps(data, out, maps, pictures)
+    for name in stale:
+      manifest.update(name, inputs[name])
+    manifest.save()
+
+  ##
+  # write the summary of the tour to stats.json and print it
+  def writeStats(self, stats:dict, out):
+    with open(os.path.join(out, "stats.json"), "w") as f:
+      json.dump(stats, f, indent=1)
+    print("distance: {distance} km, elevation gain: {elevationGain} m, loss: {elevationLoss} m, average speed: {averageSpeed} km/h".format(**stats))
+    return stats
+
+  ##
+  # render the maps, in worker processes if there is more than one
+  def renderMaps(self, data:RenderData, out, maps, pictures):
+    jobs = min(self.renderJobs, len(maps))
+    if jobs > 1:
+      with ProcessPoolExecutor(jobs) as pool:
+        settings = {name: getattr(self, name) for name in self.RENDER_SETTINGS}
+        futures = [pool.submit(renderMap, settings, self.stats.enabled, name, data, out) for name in maps]
+        # the pictures are processed while the maps are rendered
+        self.processPictures(pictures, out)
+        for future in futures:
+          # the workers record their stages on their own
+          self.stats.extend(future.result())
+    else:
+      for name in maps:
+        self.renderStage(name, data, out)
+      self.processPictures(pictures, out)
+
+  ##
+  # simplify the track for a single map and render it, as a stage of the build stats
+  def renderStage(self, name, data:RenderData, out):
+    method = self.MAPS[name]
+    with self.stats.stage(method, segments=data.track.segmentCount(), photos=len(data.pictures)):
+      with self.stats.stage("simplify", points=len(data.track)):
+        data.kept[name] = self.simplify(name + " map", data.track, data.colours[name])
+      getattr(self, method)(data, out)
+
+  def getPageName(self, args):
+    return "index.md" if args.createJekyllMd else "index.html"
+
+  ##
+  # hashes of the inputs of every generated file
+  def getBuildInputs(self, args, gpxData, imageFolder, out, cfg:Config, track:Track=None):
+    common = {
+      # the generated files change with the code as well
+      "code": fileHash(os.path.abspath(__file__)),
+      "gpx": self.getGpxHash(gpxData),
+      "cfg": hashlib.sha256(json.dumps(cfg.__dict__, sort_keys=True).encode()).hexdigest(),
+    }
+    maps = common | {"map": fileHash(os.path.join(out, "map.svg"))}
+    # pictures are identified by name, size and mtime, hashing their content would take as long as processing them
+    # listing them needs no timestamps, except for the time range of the track in a photo index that has them already
+    if self.photoIndex is not None and track is not None:
+      images = [(root, f) for root, f, _ in self.findTourImages(imageFolder, track)]
+    else:
+      images = findImages(imageFolder)
+    photos = []
+    for root, f in images:
+      stat = os.stat(os.path.join(root, f))
+      photos.append([os.path.relpath(os.path.join(root, f), imageFolder), stat.st_size, stat.st_mtime_ns])
+    photos.sort()
+    template = "jekyll_template.md" if args.createJekyllMd else "template.html"
+    photosHash = hashlib.sha256(json.dumps(photos).encode()).hexdigest()
+    inputs = {
+      self.getPageName(args): common | {"template": fileHash(PageTemplate.path(template)), "photos": photosHash},
+      "stats.json": common,
+      "picture.svg": maps | {"photos": photosHash},
+      "elevation.svg": maps,
+      "speed.svg": maps,
+      "legs.svg": maps,
+    }
+    if cfg.PhotoLayer == "lazy":
+      # written together with the picture map
+      inputs["photos.json"] = inputs["picture.svg"]
+    return inputs
+
+  ##
+  # whether all files of a tour are up to date
+  def isUpToDate(self, args, gpxFile, imageFolder, out, cfg:Config):
+    if self.force or not os.path.exists(os.path.join(out, BuildManifest.FILENAME)):
+      return False
+    manifest = BuildManifest(out)
+    # kept for rendering the tour if it isn't up to date
+    self.buildInputs = self.getBuildInputs(args, gpxFile, imageFolder, out, cfg)
+    return all(manifest.isUpToDate(name, self.buildInputs[name]) for name in self.buildInputs)
+
+  ##
+  # write the page of the tour from its template
+  def createPage(self, args, out, cfg:Config, stats:dict, photoCount:int):
+    values = {
+      "TOURTITLE": self.tourname,
+      "MAP_DATE": cfg.creationDate,
+      "CREATION_DATE": datetime.today().strftime('%Y-%m-%d'),
+      "COORDINATES": self.mapCenter,
+      "DISTANCE": "{:.1f}".format(stats["distance"]),
+      "ELEVATION_GAIN": "{:.0f}".format(stats["elevationGain"]),
+      "ELEVATION_LOSS": "{:.0f}".format(stats["elevationLoss"]),
+      "PHOTO_COUNT": photoCount,
+    }
+    template = "jekyll_template.md" if args.createJekyllMd else "template.html"
+    # unix line endings on every platform, jekyll pages were written as bytes before
+    with open(os.path.join(out, self.getPageName(args)), "w", encoding="utf-8", newline="\n") as f:
+      f.write(PageTemplate.load(template).render(values))
+
+  ##
+  # get the timestamp of the picture, from its file name or exif data
+  def getTimestamp(self, path):
+    if self.photoTimestamps is None:
+      # pictures named by UTC time are shifted by the zone of the tour
+      self.photoTimestamps = PhotoTimestamps(self.tzOffset)
+    timestamp = self.photoTimestamps.get(path)
+    if timestamp is None:
+      print ("could not match date of image name:", os.path.basename(path))
+    return timestamp
 
   def main(self, args, gpxFile, imageFolder, out, cfg:Config, recreate=False):
-    self.tourname = self.getTrackName(gpxFile)
-    if out is None:
-      out = "./tours/" + self.tourname
     self.margin = cfg.Margin
     self.shrink = cfg.Shrink
+    self.tzOffset = cfg.TzOffset
+    self.photoTolerance = cfg.PhotoTolerance
+    self.simplifyTolerance = cfg.SimplifyTolerance
+    self.trackStyle = cfg.TrackStyle
+    self.smoothWindow = cfg.SmoothWindow
+    self.photoLayer = cfg.PhotoLayer
     self.recreate = recreate
+    self.force = getattr(args, "force", False)
+    self.stats = BuildStats(getattr(args, "profile", False))
+    with self.stats.stage("main"):
+      out = self.buildTour(args, gpxFile, imageFolder, out, cfg)
+    # skipped tours keep the stats of their last build
+    if out is not None:
+      self.stats.save(out)
+    return self.stats
+
+  ##
+  # build the tour, returns the output folder or None if the tour was up to date
+  def buildTour(self, args, gpxFile, imageFolder, out, cfg:Config):
+    recreate = self.recreate
+    self.buildInputs = None
+    # new tours always need the map, existing ones can be skipped before even reading the gpx file
+    if recreate and out is not None and self.isUpToDate(args, gpxFile, imageFolder, out, cfg):
+      print("tour is up to date, skipping")
+      return None
+    # the cache is next to the cfg.json, that is in the tour folder or is written to the output folder
+    self.cacheDir = os.path.dirname(gpxFile) if recreate else out
+    self.tourname = self.getTrackName(gpxFile)
+    if out is None:
+      out = os.path.join(self.toursDir, self.tourname)
+      self.cacheDir = out
     self.createMaps(args, gpxFile, imageFolder, out, cfg)
+    return out
+
+##
+# render a single map, runs in the worker processes of MapCreator.renderMaps, returns the stats of the map
+# settings are the MapCreator.RENDER_SETTINGS, the caches and indexes of the tour stay in the main process
+def renderMap(settings:dict, profile:bool, name, data:RenderData, out):
+  mc = MapCreator()
+  for attribute, value in settings.items():
+    setattr(mc, attribute, value)
+  # only the stages of this map go back to the main process
+  mc.stats = BuildStats(profile)
+  mc.renderStage(name, data, out)
+  return mc.stats
+
+##
+# find the gpx and the cfg file of a tour folder
+def findTourFiles(projDir):
+  gpxFile = ""
+  cfgFile = ""
+  for entry in os.scandir(projDir):
+    if not entry.is_file():
+      continue
+    if entry.name.lower().endswith("gpx"):
+      gpxFile = entry.path
+    if entry.name.lower()=="cfg.json":
+      cfgFile = entry.path
+  return gpxFile, cfgFile
+
+##
+# recreate a single tour, returns the tour, the duration in s, the error if it failed and the build stats
+def recreateTour(args, toursDir, dir):
+  start = time.perf_counter()
+  mc = None
+  try:
+    print("recreating tour " + dir)
+    projDir = os.path.join(toursDir, dir)
+    gpxFile, cfgFile = findTourFiles(projDir)
+    mc = MapCreator()
+    if (getattr(args, "jobs", 1) or 1) > 1:
+      # the tours already run in parallel
+      mc.renderJobs = 1
+    # create cfg with defaults
+    cfg = Config(0.005, True)
+    with open(cfgFile, "r") as f:
+      s = f.read()
+      # override saved config
+      cfg.__dict__ = cfg.__dict__ | json.loads(s)
+    stats = mc.main(args, gpxFile, projDir, os.path.join(args.out, dir), cfg, recreate=True)
+    return dir, time.perf_counter()-start, None, stats
+  except Exception:
+    # one broken tour must not stop the others
+    return dir, time.perf_counter()-start, traceback.format_exc(), mc.stats if mc is not None else None
+
+##
+# create new tours from all gpx files of a folder
+# the image folder is scanned once, every tour gets the pictures taken during its track
+def createNewProjects(args, gpxFolder, imageFolder):
+  start = time.perf_counter()
+  photoTimestamps = PhotoTimestamps(args.tzOffset)
+  photoIndex = PhotoIndex(imageFolder, photoTimestamps)
+  photoTimestamps.save()
+  print("pictures found: ", len(photoIndex))
+  gpxFiles = sorted(entry.path for entry in os.scandir(gpxFolder) if entry.is_file() and entry.name.lower().endswith(".gpx"))
+  results = []
+  for gpxFile in gpxFiles:
+    tourStart = time.perf_counter()
+    mc = MapCreator()
+    try:
+      print("creating tour " + os.path.basename(gpxFile))
+      mc.photoIndex = photoIndex
+      configureMaps(mc, args)
+      if args.out is not None:
+        mc.toursDir = args.out
+      cfg = Config(args.margin, args.shrinkImages, args.tzOffset, args.photoTolerance, args.simplify, args.trackStyle, args.smooth, args.photoLayer)
+      stats = mc.main(args, gpxFile, imageFolder, None, cfg)
+      results.append((os.path.basename(gpxFile), time.perf_counter()-tourStart, None, stats))
+    except Exception:
+      # one broken gpx file must not stop the others
+      results.append((os.path.basename(gpxFile), time.perf_counter()-tourStart, traceback.format_exc(), mc.stats))
+  printSummary(results, time.perf_counter()-start, "created")
+  saveBuildStats(args, args.out if args.out is not None else MapCreator.TOURS_DIR, results)
+  return results
 
 def recreateExistingProjects(args, toursDir):
-  for root, dirs, _ in os.walk(toursDir):
-    if root == toursDir:
-      for dir in dirs:
-        print("recreating tour " + dir)
-        gpxFile = ""
-        cfgFile = ""
-        projDir = os.path.join(root, dir)
-        for r, _, files  in os.walk(projDir):
-          for file in files:
-            if file.lower().endswith("gpx"):
-              gpxFile = os.path.join(projDir, file) 
-            if file.lower()=="cfg.json":
-              cfgFile = os.path.join(projDir, file) 
-        mc = MapCreator()
-        # create cfg with defaults
-        cfg = Config(0.005, True)
-        with open(cfgFile, "r") as f:
-          s = f.read()
-          # override saved config
-          cfg.__dict__ = cfg.__dict__ | json.loads(s)
-        mc.main(args, gpxFile, projDir, os.path.join(args.out, dir), cfg, recreate=True)
+  dirs = sorted(entry.name for entry in os.scandir(toursDir) if entry.is_dir())
+  jobs = getattr(args, "jobs", 1) or 1
+  results = []
+  start = time.perf_counter()
+  if jobs > 1 and len(dirs) > 1:
+    # a fresh process per tour, so the memory of one tour doesn't count for the next
+    with (ProcessPoolExecutor(jobs, max_tasks_per_child=1) if sys.version_info >= (3, 11) else ProcessPoolExecutor(jobs)) as pool:
+      futures = {pool.submit(recreateTour, args, toursDir, dir): dir for dir in dirs}
+      for future in as_completed(futures):
+        try:
+          results.append(future.result())
+        except Exception:
+          # the worker process itself died
+          results.append((futures[future], 0, traceback.format_exc(), None))
+  else:
+    for dir in dirs:
+      results.append(recreateTour(args, toursDir, dir))
+  printSummary(results, time.perf_counter()-start, "recreated")
+  saveBuildStats(args, args.out, results)
+  return results
+
+##
+# print the timings of all tours, slowest first, and the errors of the failed ones
+def printSummary(results, duration, action):
+  failed = [result for result in results if result[2] is not None]
+  print()
+  print("{action} {ok} of {total} tours in {duration:.1f} s".format(action=action, ok=len(results)-len(failed), total=len(results), duration=duration))
+  for dir, seconds, error, _ in sorted(results, key=lambda result: result[1], reverse=True):
+    print("  {seconds:8.2f} s  {status:6}  {dir}".format(seconds=seconds, status="failed" if error else "ok", dir=dir))
+  for dir, _, error, _ in failed:
+    print()
+    print("tour " + dir + " failed:")
+    print(error)
+
+##
+# set the map provider and the map cache of new tours from the command line
+def configureMaps(mc:MapCreator, args):
+  if args.mapProvider == FilesystemMapProvider.NAME:
+    mc.mapProvider = FilesystemMapProvider(args.mapDir)
+  else:
+    mc.mapProvider = ManualMapProvider()
+  mc.mapCache = MapCache(args.mapCache) if args.mapCache else None
+
+##
+# aggregate the build stats of all tours into build_stats.json of the output folder, only with --profile
+def saveBuildStats(args, out, results):
+  if not getattr(args, "profile", False) or out is None or not os.path.isdir(out):
+    return
+  tours = []
+  stages = {}
+  for dir, seconds, error, stats in sorted(results, key=lambda result: result[1], reverse=True):
+    totals = stats.totals() if stats is not None else {}
+    tours.append({"tour": dir, "seconds": round(seconds, 6), "failed": error is not None, "stages": totals})
+    for name, total in totals.items():
+      stage = stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "tours": 0, "peakRss": None})
+      stage["wall"] += total["wall"]
+      stage["cpu"] += total["cpu"]
+      stage["tours"] += 1
+      if total["peakRss"] is not None:
+        stage["peakRss"] = max(stage["peakRss"] or 0, total["peakRss"])
+  with open(os.path.join(out, BuildStats.FILENAME), "w") as f:
+    json.dump({"tours": tours, "stages": stages}, f, indent=1)
+  print()
+  print("time per stage over all tours:")
+  for name, stage in sorted(stages.items(), key=lambda item: item[1]["wall"], reverse=True):
+    print("  {name:<24} {wall:9.3f} s wall {cpu:9.3f} s cpu  {tours} tours".format(name=name, **stage))
 
 def printHelp(parser):
     # print main help
@@ -513,25 +2272,50 @@ if __name__=="__main__":
   sp = parser.add_subparsers(dest="type")
   parser_new = sp.add_parser("new",  help="create a new tracks")
   parser_recreate = sp.add_parser("recreate", help="recreate existing tracks")
+  parser_batch = sp.add_parser("batch", help="create new tracks from all gpx files of a folder")
 
   parser_new.add_argument("gpxFile", help="gpx file to analyze, if provided requies image folder parameter")
   parser_new.add_argument("imageFolder", help="folder of the images to include into the map file")
-  parser_new.add_argument("--margin", help="margin to the side of the map from the track [° of latitude/longitude]", default=0.005, type=float)
-  parser_new.add_argument("--shrinkImages", help="shrink the images to use PILs thumbnails instead", action='store_true')
+  parser_batch.add_argument("gpxFolder", help="folder of the gpx files to analyze")
+  parser_batch.add_argument("imageFolder", help="folder of the images of all tracks, every track gets the images taken during it")
+  for p in [parser_new, parser_batch]:
+    p.add_argument("--margin", help="margin to the side of the map from the track [° of latitude/longitude]", default=0.005, type=float)
+    p.add_argument("--shrinkImages", help="shrink the images to use PILs thumbnails instead", action='store_true')
+    p.add_argument("--tzOffset", help="offset of the local time to the UTC time of the gpx data [h]", default=2, type=float)
+    p.add_argument("--photoTolerance", help="max time between a picture and the closest segment of the track [s]", default=60, type=float)
+    p.add_argument("--simplify", help="max deviation of the drawn track from the recorded one, 0 to draw every recorded segment [map units]", default=0.5, type=float)
+    p.add_argument("--smooth", help="number of points the elevation and speed are averaged over for the colours, 1 to not smooth", default=5, type=int)
+    p.add_argument("--mapProvider", help="manual: export the map from openstreetmap by hand, filesystem: take the map from --mapDir", default=ManualMapProvider.NAME, choices=[ManualMapProvider.NAME, FilesystemMapProvider.NAME])
+    p.add_argument("--mapDir", help="folder of the maps of the filesystem provider, named <min lon>_<min lat>_<max lon>_<max lat>_<scale>.svg")
+    p.add_argument("--mapCache", help="folder of the map cache shared by all tours, empty to not cache maps", default=MapCache.defaultPath())
+    p.add_argument("--photoLayer", help="inline: every picture marker in picture.svg, lazy: markers loaded from photos.json and only drawn in view, with thumbnails in several sizes", default="inline", choices=["inline", "lazy"])
+    p.add_argument("--trackStyle", help="path: merge segments of the same colour into one svg path, lines: one svg line per segment", default="path", choices=["path", "lines"])
   parser_recreate.add_argument("recreateProjectsFrom", help="recreate projects from this location")
+  parser_recreate.add_argument("--jobs", help="number of tours to recreate in parallel", default=1, type=int)
   parser.add_argument("--out", help="output destination, everything will be copied there")
   parser.add_argument("--createJekyllMd", help="create a jekyll compatible md file instead of an index.html", action='store_true')
+  parser.add_argument("--force", help="generate all files, even if their inputs didn't change", action='store_true')
+  parser.add_argument("--profile", help="record the time, counts and memory of every stage in build_stats.json", action='store_true')
   args = parser.parse_args()
+  if getattr(args, "mapProvider", None) == FilesystemMapProvider.NAME and not args.mapDir:
+    parser.error("the filesystem map provider needs --mapDir")
   if args.type == None:
     printHelp(parser)
     exit(0)
   if args.type == "new":
-    cfg = Config(args.margin, args.shrinkImages)
+    cfg = Config(args.margin, args.shrinkImages, args.tzOffset, args.photoTolerance, args.simplify, args.trackStyle, args.smooth, args.photoLayer)
     out = args.out
     mc = MapCreator()
+    configureMaps(mc, args)
     mc.main(args, args.gpxFile, args.imageFolder, out, cfg)
   elif args.type == "recreate":
-    recreateExistingProjects(args, args.recreateProjectsFrom)
+    results = recreateExistingProjects(args, args.recreateProjectsFrom)
+    if any(error is not None for _, _, error, _ in results):
+      exit(1)
+  elif args.type == "batch":
+    results = createNewProjects(args, args.gpxFolder, args.imageFolder)
+    if any(error is not None for _, _, error, _ in results):
+      exit(1)
   else:
     printHelp(parser)
   
@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+import svgwrite
+from PIL import Image
+from GpxAnalyzer import TimestampDecoder, toEpochNs, GpxReader, MapCreator, PhotoTimestamps, ImageStage, peakRss
+
+## start of the synthetic tracks, UTC
+START = datetime(2023, 7, 2, 7, 0, 0)
+## offset of the local time of the pictures to UTC in hours
+TZOFFSET = 2
+## pause between the legs of a synthetic track in s, long enough to start a new leg
+LEGBREAK = 4*3600
+
+##
+# timestamp parsing as done before the TimestampDecoder, kept as reference
+def legacyDecode(time):
+  try:
+    return datetime.strptime(time,'%Y-%m-%dT%H:%M:%SZ')+timedelta(hours=2, minutes=0)
+  except:
+    return datetime.strptime(time,'%Y-%m-%dT%H:%M:%S.%fZ')+timedelta(hours=2, minutes=0)
+
+##
+# gpx timestamps one second apart, with milliseconds like garmin devices write them
+def createTimestamps(count, millis=True):
+  start = datetime(2023, 7, 2, 7, 0, 0)
+  times = []
+  for i in range(count):
+    timestamp = start+timedelta(seconds=i, milliseconds=i%1000 if millis else 0)
+    if millis:
+      times.append(timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+"Z")
+    else:
+      times.append(timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'))
+  return times
+
+##
+# run func on the timestamps and return the points per second
+def measure(func, times):
+  start = time.perf_counter()
+  func(times)
+  return len(times)/(time.perf_counter()-start)
+
+def benchTimestamps(count):
+  decoder = TimestampDecoder()
+  results = {}
+  for millis in [True, False]:
+    times = createTimestamps(count, millis)
+    variant = "millis" if millis else "seconds"
+    results[variant] = {
+      "legacy strptime": measure(lambda ts: [toEpochNs(legacyDecode(t)) for t in ts], times),
+      "fromisoformat": measure(lambda ts: [toEpochNs(decoder.decode(t)) for t in ts], times),
+      "batch": measure(decoder.decodeNs, times),
+    }
+  return results
+
+##
+# UTC time of point i of a synthetic track, one point per second and a break between the legs
+def pointTime(i, points, legs):
+  perLeg = math.ceil(points/legs)
+  return START+timedelta(seconds=i+(i//perLeg)*LEGBREAK)
+
+##
+# write a gpx file with a random walk of points split into legs, one track per leg
+def createGpx(path, points, legs, seed=0):
+  rng = np.random.default_rng(seed)
+  # about 1.4 m per step, some noise on the elevation like a real recording
+  lat = 47.2+np.cumsum(rng.normal(0, 1e-5, points))
+  lon = 11.5+np.cumsum(rng.normal(0, 1e-5, points))
+  ele = 900+300*np.sin(np.arange(points)/3000)+rng.normal(0, 2, points)
+  perLeg = math.ceil(points/legs)
+  with open(path, "w", encoding="utf-8") as f:
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">\n')
+    f.write('<wpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>900</ele><time>{t}Z</time><desc>Start</desc></wpt>\n'.format(lat=lat[0], lon=lon[0], t=START.isoformat()))
+    for leg in range(legs):
+      f.write('<trk><name>Benchmark leg {leg}</name><trkseg>\n'.format(leg=leg+1))
+      lines = []
+      for i in range(leg*perLeg, min((leg+1)*perLeg, points)):
+        timestamp = pointTime(i, points, legs)
+        # milliseconds like garmin devices write them, the same for every point so the points stay one second apart
+        lines.append('<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele><time>{t}.250Z</time></trkpt>\n'.format(lat=lat[i], lon=lon[i], ele=ele[i], t=timestamp.isoformat()))
+      f.writelines(lines)
+      f.write('</trkseg></trk>\n')
+    f.write('</gpx>\n')
+
+##
+# write tiny jpegs named like android pictures, taken at points spread evenly over the track
+def createPhotos(folder, count, points, legs, size=(64, 48)):
+  os.makedirs(folder, exist_ok=True)
+  for n, i in enumerate(np.linspace(0, points-1, count).astype(int).tolist() if count else []):
+    timestamp = pointTime(i, points, legs)+timedelta(hours=TZOFFSET)
+    name = "IMG_{t}_{ms:03d}.jpg".format(t=timestamp.strftime("%Y%m%d_%H%M%S"), ms=n%1000)
+    Image.new("RGB", size, (n*37%256, n*91%256, 120)).save(os.path.join(folder, name), quality=80)
+
+##
+# write a map without content, only its size is used
+def createMap(path, height=1000, width=1400):
+  dwg = svgwrite.Drawing(path, size=("{w}pt".format(w=width), "{h}pt".format(h=height)))
+  dwg.save()
+
+##
+# timings of the stages of one benchmark run
+# with traceMemory the peak memory of every stage is recorded as well, the peak of the memory the stage
+# allocated as traced by tracemalloc. tracing slows the stages down several times, so the timings of
+# such a run are not comparable. tracemalloc sees the python objects and numpy arrays of this process
+# but not the worker processes
+class StageTimer:
+  def __init__(self, traceMemory:bool=False) -> None:
+    self.stages = {}
+    self.traceMemory = traceMemory
+
+  ##
+  # time the stage, count is the number of items it handles for the throughput
+  @contextlib.contextmanager
+  def stage(self, name, count):
+    if self.traceMemory:
+      # tracing starts from zero for every stage
+      tracemalloc.start()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter()-start
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+    self.stages[name] = {
+      "seconds": round(seconds, 6),
+      "items": count,
+      "itemsPerSecond": round(count/seconds, 1) if seconds > 0 else None,
+    }
+    if self.traceMemory:
+      self.stages[name]["peakMemory"] = peak
+
+##
+# write the synthetic track and pictures of a tour to folder
+def createTour(folder, points, legs, photos):
+  createGpx(os.path.join(folder, "track.gpx"), points, legs)
+  createPhotos(os.path.join(folder, "images"), photos, points, legs)
+
+##
+# run the stages of the tour in folder into a new output folder out, returns the timings
+# or with traceMemory the peak memory of the stages
+def benchPipeline(folder, out, points, legs, photos, workers=None, traceMemory=False):
+  gpxFile = os.path.join(folder, "track.gpx")
+  imageFolder = os.path.join(folder, "images")
+  os.makedirs(out, exist_ok=True)
+  createMap(os.path.join(out, "map.svg"))
+
+  timer = StageTimer(traceMemory)
+  mc = MapCreator()
+  mc.tzOffset = TZOFFSET
+  # keep the exif memo out of the users cache
+  mc.photoTimestamps = PhotoTimestamps(TZOFFSET, os.path.join(folder, "photo_timestamps.json"))
+  mc.size = mc.readMapSize(os.path.join(out, "map.svg"))
+  with timer.stage("parse", points):
+    _, _, track = GpxReader(TimestampDecoder(TZOFFSET)).read(gpxFile)
+  with timer.stage("scale", points):
+    mc.getMapLink(track)
+    track.scale(mc.topleft, mc.botright, mc.size)
+  with timer.stage("segments", track.segmentCount()):
+    track.computeSegments()
+  with timer.stage("photo timestamps", photos):
+    images = mc.findTourImages(imageFolder)
+  with timer.stage("photo matching", photos):
+    segments = mc.getSegments(track, [timestamp for _, _, timestamp in images])
+  pictures = [(segment, f, os.path.join(root, f)) for (root, f, _), segment in zip(images, segments) if segment is not None]
+  with timer.stage("render data", track.segmentCount()):
+    data = mc.prepareRenderData(track, [(segment, f) for segment, f, _ in pictures], list(MapCreator.MAPS))
+  mc.buffer = []
+  dwg = svgwrite.Drawing()
+  for segment, f in data.pictures:
+    mc.addImageCircleToBuffer(dwg, track, segment, f)
+  with timer.stage("marker layout", len(mc.buffer)):
+    mc.addBufferedImageCircles(dwg)
+  for name in MapCreator.MAPS:
+    # simplifying the track is part of rendering the map
+    with timer.stage("svg " + name, track.segmentCount()):
+      mc.renderStage(name, data, out)
+  with timer.stage("thumbnails", len(pictures)):
+    ImageStage(out, True, workers=workers).process([(src, f) for _, f, src in pictures])
+  return {
+    "points": points,
+    "legs": legs,
+    "photos": photos,
+    "matchedPhotos": len(pictures),
+    "stages": timer.stages,
+    "totalSeconds": round(sum(stage["seconds"] for stage in timer.stages.values()), 6),
+  }
+
+##
+# commit of the working tree, to compare results between commits
+def gitCommit():
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser(prog="benchmark", description="benchmarks for the GpxAnalyzer, runs offline on synthetic data and prints the results as json")
+  parser.add_argument("--points", help="number of track points, several values run the benchmarks for each", default=[200000], type=int, nargs="+")
+  parser.add_argument("--legs", help="number of legs of the synthetic tracks", default=3, type=int)
+  parser.add_argument("--photos", help="number of pictures taken on the synthetic tracks", default=200, type=int)
+  parser.add_argument("--workers", help="number of processes creating the thumbnails", default=None, type=int)
+  parser.add_argument("--suite", help="benchmarks to run", default=["timestamps", "pipeline"], choices=["timestamps", "pipeline"], nargs="+")
+  parser.add_argument("--memory", help="measure the peak memory of every pipeline stage in a second run with tracemalloc", default=True, action=argparse.BooleanOptionalAction)
+  parser.add_argument("--keep", help="folder to keep the synthetic data and the output in, a temporary folder otherwise")
+  parser.add_argument("--output", help="file to write the json results to, stdout otherwise")
+  args = parser.parse_args()
+  results = {
+    "commit": gitCommit(),
+    "date": datetime.now().isoformat(timespec="seconds"),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "runs": [],
+  }
+  for points in args.points:
+    run = {"points": points}
+    if "timestamps" in args.suite:
+      run["timestamps"] = {variant: {name: round(rate, 1) for name, rate in rates.items()} for variant, rates in benchTimestamps(points).items()}
+    if "pipeline" in args.suite:
+      with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(args.keep, str(points)) if args.keep else tmp
+        os.makedirs(folder, exist_ok=True)
+        # the progress output of the stages must not mix with the json results
+        with contextlib.redirect_stdout(sys.stderr):
+          createTour(folder, points, args.legs, args.photos)
+          run["pipeline"] = benchPipeline(folder, os.path.join(folder, "out"), points, args.legs, args.photos, args.workers)
+          if args.memory:
+            # a second run for the memory, tracing would distort the timings
+            memory = benchPipeline(folder, os.path.join(folder, "out-memory"), points, args.legs, args.photos, args.workers, traceMemory=True)
+            for name, stage in memory["stages"].items():
+              run["pipeline"]["stages"][name]["peakMemory"] = stage["peakMemory"]
+    results["runs"].append(run)
+  results["peakMemory"] = peakRss()
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=1)
+  else:
+    print(json.dumps(results, indent=1))